@@ -0,0 +1,229 @@
+"""
+Benchmarks for condor.py that run entirely on the local machine.
+Python 3
+
+Fake 'ssh', 'condor_submit', 'condor_q' and 'which' programs are put at the
+front of the PATH so that no Condor pool (or network) is needed.  Each fake
+program waits '--latency' seconds before doing anything, to stand in for a
+slow link to the submit server.  The fake 'condor_q' prints
+'--queue-lines' lines for every cluster still in the queue, and every
+submitted cluster finishes '--runtime' seconds after it was submitted.
+
+Run "python3 benchmark.py --help" for the options.  It measures:
+  - how fast Job objects can be created, and the cost of the first probe
+  - queue() and queueMany() throughput
+  - the size of the submit description and how long it takes to generate
+  - how long wait() takes to notice that a cluster finished, both by
+    polling 'condor_q' and by following the user log
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import argparse
+from time import perf_counter, sleep, time
+
+FAKE_SSH = r"""#!/bin/sh
+# Runs the "remote" command locally
+sleep "$CONDOR_BENCH_LATENCY"
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -O) exit 0;;
+        -o) shift 2;;
+        -*) shift;;
+        *) break;;
+    esac
+done
+shift
+[ $# -eq 0 ] && exit 0
+exec /bin/sh -c "$*"
+"""
+
+FAKE_CONDOR_SUBMIT = r"""#!/bin/sh
+sleep "$CONDOR_BENCH_LATENCY"
+dir="$CONDOR_BENCH_DIR"
+n=$(cat "$dir/next_cluster" 2>/dev/null || echo 1)
+echo $((n + 1)) > "$dir/next_cluster"
+cat > "$dir/submit_$n.sub"
+procs=$(awk '/^Queue/ { if ($2 ~ /^[0-9]+$/) p += $2; else p += 1 } END { print p + 0 }' "$dir/submit_$n.sub")
+finish=$(awk "BEGIN { printf \"%.3f\", $(date +%s.%N) + $CONDOR_BENCH_RUNTIME }")
+echo "$procs $finish" > "$dir/cluster_$n"
+log=$(sed -n 's/^Log = //p' "$dir/submit_$n.sub" | tail -n 1)
+if [ -n "$log" ]; then
+    (
+        i=0
+        while [ $i -lt $procs ]; do
+            printf '000 (%03d.%03d.000) 01/01 00:00:00 Job submitted\n...\n' $n $i
+            i=$((i + 1))
+        done >> "$log"
+        sleep "$CONDOR_BENCH_RUNTIME"
+        i=0
+        while [ $i -lt $procs ]; do
+            printf '005 (%03d.%03d.000) 01/01 00:00:00 Job terminated.\n...\n' $n $i
+            i=$((i + 1))
+        done >> "$log"
+    ) >/dev/null 2>&1 &
+fi
+echo "Submitting job(s)."
+echo "$procs job(s) submitted to cluster $n."
+"""
+
+FAKE_CONDOR_Q = r"""#!/bin/sh
+sleep "$CONDOR_BENCH_LATENCY"
+dir="$CONDOR_BENCH_DIR"
+now=$(date +%s.%N)
+for arg in "$@"; do
+    case "$arg" in
+        *[!0-9]*|"") continue;;
+    esac
+    [ -f "$dir/cluster_$arg" ] || continue
+    awk -v now="$now" -v c="$arg" -v lines="$CONDOR_BENCH_QUEUE_LINES" \
+        '{ if (now < $2) for (i = 0; i < lines; i++) printf "%d.%d\n", c, i }' \
+        "$dir/cluster_$arg"
+done
+exit 0
+"""
+
+FAKE_WHICH = r"""#!/bin/sh
+sleep "$CONDOR_BENCH_LATENCY"
+exec %s "$@"
+"""
+
+def installFakes(directory, latency, runtime, queueLines):
+    """installFakes(directory, latency, runtime, queueLines)
+    Writes the fake programs into 'directory', puts it first on the PATH
+    and sets the environment variables they read."""
+    realWhich = shutil.which("which")
+    fakes = {"ssh": FAKE_SSH, "condor_submit": FAKE_CONDOR_SUBMIT,
+             "condor_q": FAKE_CONDOR_Q, "which": FAKE_WHICH % realWhich}
+    for name in fakes:
+        path = os.path.join(directory, name)
+        f = open(path, 'w')
+        f.write(fakes[name])
+        f.close()
+        os.chmod(path, 0o755)
+    os.environ["PATH"] = directory + os.pathsep + os.environ["PATH"]
+    os.environ["CONDOR_BENCH_DIR"] = directory
+    os.environ["CONDOR_BENCH_LATENCY"] = str(latency)
+    os.environ["CONDOR_BENCH_RUNTIME"] = str(runtime)
+    os.environ["CONDOR_BENCH_QUEUE_LINES"] = str(queueLines)
+
+def report(name, seconds, count=None, extra=""):
+    """report(name, seconds, count=None, extra="")
+    Prints one result line."""
+    line = "%-40s %10.4fs" % (name, seconds)
+    if count:
+        line += "  %12.0f/s" % (count / seconds if seconds else float("inf"))
+    if extra:
+        line += "  " + extra
+    print(line)
+
+def newJob(condor, remote):
+    """newJob(condor, remote) -> Job
+    Returns a Job that submits locally, or through the fake SSH if
+    'remote' is True."""
+    if remote:
+        return condor.Job(username="benchmark")
+    return condor.Job()
+
+def benchConstruction(condor, count, remote):
+    """benchConstruction(condor, count, remote)
+    Times creating Jobs and the first use of the environment probes."""
+    condor.environment.invalidate()
+    start = perf_counter()
+    for i in range(count):
+        job = newJob(condor, remote)
+    report("Job() x " + str(count), perf_counter() - start, count)
+    start = perf_counter()
+    job._submitShell
+    report("first environment probe", perf_counter() - start)
+
+def benchQueue(condor, size, remote):
+    """benchQueue(condor, size, remote)
+    Times queue() and queueMany() and generating their submit strings."""
+    commands = ["echo " + str(i) + " benchmark" for i in range(size)]
+    condor.executables.invalidate()
+    job = newJob(condor, remote)
+    job.setEmail("benchmark@example.com")
+    start = perf_counter()
+    for command in commands:
+        job.queue(command)
+    report("queue() x " + str(size), perf_counter() - start, size)
+    start = perf_counter()
+    text = job._generateSubmitString(False)
+    report("  submit string", perf_counter() - start, None,
+           str(len(text)) + " bytes")
+
+    job = newJob(condor, remote)
+    job.setEmail("benchmark@example.com")
+    start = perf_counter()
+    job.queueMany(commands)
+    report("queueMany() x " + str(size), perf_counter() - start, size)
+    start = perf_counter()
+    text = job._generateSubmitString(False)
+    report("  submit string", perf_counter() - start, None,
+           str(len(text)) + " bytes")
+
+def benchWait(condor, size, remote, useLog, directory):
+    """benchWait(condor, size, remote, useLog, directory)
+    Times how long after a cluster of 'size' processes finishes wait()
+    returns."""
+    job = newJob(condor, remote)
+    job.setEmail("benchmark@example.com")
+    if useLog:
+        log = os.path.join(directory, "wait_" + str(size) + ".log")
+        job.setLog(log)
+    job.queue("echo benchmark", size)
+    start = perf_counter()
+    job.submit()
+    report("  submit()", perf_counter() - start)
+    f = open(os.path.join(directory, "cluster_" + str(job.cluster)))
+    finish = float(f.read().split()[1])
+    f.close()
+    job.wait()
+    latency = time() - finish
+    if useLog:
+        name = "wait() via user log, " + str(size) + " procs"
+    else:
+        name = "wait() via condor_q, " + str(size) + " procs"
+    report(name, latency, None, "after the cluster finished")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark condor.py "
+                                     + "against fake Condor programs.")
+    parser.add_argument("--sizes", default="10,10000,100000",
+                        help="comma-separated numbers of jobs to queue")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="seconds each fake program waits")
+    parser.add_argument("--runtime", type=float, default=2.0,
+                        help="seconds until a submitted cluster finishes")
+    parser.add_argument("--queue-lines", type=int, default=10,
+                        help="lines condor_q prints per queued cluster")
+    parser.add_argument("--jobs", type=int, default=1000,
+                        help="number of Job objects to create")
+    parser.add_argument("--remote", action="store_true",
+                        help="submit through the fake ssh")
+    parser.add_argument("--no-wait", action="store_true",
+                        help="skip the wait() benchmarks")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="condor-bench-")
+    try:
+        installFakes(directory, args.latency, args.runtime, args.queue_lines)
+        import condor
+        sizes = [int(size) for size in args.sizes.split(",")]
+        benchConstruction(condor, args.jobs, args.remote)
+        for size in sizes:
+            benchQueue(condor, size, args.remote)
+        if not args.no_wait:
+            for size in sizes:
+                benchWait(condor, size, args.remote, False, directory)
+                benchWait(condor, size, args.remote, True, directory)
+        print()
+        print(condor.instrumentation.summary())
+    finally:
+        shutil.rmtree(directory, True)
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,7 @@
 Garrett Heath Koller
 Washington and Lee University
 Python Condor
-Python 3.1
+Python 3.8 or newer
 This module makes it easy for users to submit command-line based programs
 as jobs to a Condor system.  Essentially, the user can generate a list of
 commands to submit on their own, instantiate a Condor object with the desired
@@ -10,16 +10,41 @@ settings, and then pass the list into a submit function.
 """
 
 import sys
+import os
+import io
 from io import BytesIO
 import re
+import codecs
 import subprocess
 import shlex
 import pickle
+import sqlite3
+import hashlib
+import tarfile
+import atexit
+import shutil
+import tempfile
+import mmap
+import selectors
+import uuid
+import asyncio
+import threading
+import json
+import logging
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from array import array
+from bisect import bisect_left
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, Future
+from concurrent.futures import wait as waitForFutures
+from queue import Queue, Empty
 from platform import python_version_tuple, python_version
-from time import sleep
+from time import sleep, time, perf_counter
+import random
 
-if int(python_version_tuple()[0]) < 3:
-    print("WARNING: You should use Python 3 to run this program,\nnot Python " + str(python_version()) + "!")
+if tuple(map(int, python_version_tuple()[:2])) < (3, 8):
+    print("WARNING: You should use Python 3.8 or newer to run this program,\nnot Python " + str(python_version()) + "!")
 
 class Error(Exception):
     """Error() - Should not normally be directly called.
@@ -121,19 +146,308 @@ class BadQuotes(SettingError):
         return "The supplied string contains an invalid " + str(self.value) \
                 + " character.  Remove this character and try again."
 
+class CommandRecord(object):
+    """CommandRecord(command, family, target, wallTime, bytesIn, bytesOut, exitCode)
+    What Instrumentation records about one finished command: the command
+    string, its family (the name of the program, such as 'condor_q'), the
+    machine it ran on ('local' or "user@server"), how many seconds it took,
+    how many bytes it was given and printed, and its return value."""
+
+    def __init__(self, command, family, target, wallTime, bytesIn, bytesOut,
+                 exitCode):
+        self.command = command
+        self.family = family
+        self.target = target
+        self.local = target == "local"
+        self.wallTime = wallTime
+        self.bytesIn = bytesIn
+        self.bytesOut = bytesOut
+        self.exitCode = exitCode
+        self.finished = time()
+
+    def __str__(self):
+        return "<CommandRecord: " + self.family + " on " + self.target \
+               + " took " + "%.3f" % self.wallTime + "s, " \
+               + str(self.bytesIn) + " bytes in, " + str(self.bytesOut) \
+               + " bytes out, retval " + str(self.exitCode) + ">"
+
+    def asDict(self):
+        """asDict() -> dictionary
+        Returns the record as a dictionary, for example to save it as JSON."""
+        return {"command": self.command, "family": self.family,
+                "target": self.target, "local": self.local,
+                "wallTime": self.wallTime, "bytesIn": self.bytesIn,
+                "bytesOut": self.bytesOut, "exitCode": self.exitCode,
+                "finished": self.finished}
+
+class LatencyHistogram(object):
+    """LatencyHistogram()
+    Counts command durations in buckets that double in size, starting with
+    durations under one millisecond, and keeps their count, total, minimum
+    and maximum."""
+
+    # Upper bounds of the buckets in seconds; the last bucket has none
+    bounds = [0.001 * 2 ** i for i in range(18)]
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        """add(seconds)
+        Counts one command that took 'seconds' seconds."""
+        i = bisect_left(self.bounds, seconds)
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def mean(self):
+        """mean() -> seconds"""
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def percentile(self, percent):
+        """percentile(percent) -> seconds
+        Returns an upper bound on the duration of the fastest 'percent'
+        percent of the commands, rounded up to the end of a bucket."""
+        if not self.count:
+            return None
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for i in range(len(self.buckets)):
+            seen += self.buckets[i]
+            if seen >= wanted:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                return self.max
+        return self.max
+
+class LogSink(object):
+    """LogSink(logger=None, level=logging.INFO)
+    An Instrumentation sink that writes every CommandRecord to the logging
+    module's 'logger' (by default, the "condor" logger) at 'level'."""
+
+    def __init__(self, logger=None, level=logging.INFO):
+        if logger is None:
+            logger = logging.getLogger("condor")
+        self.logger = logger
+        self.level = level
+
+    def __call__(self, record):
+        self.logger.log(self.level, "%s", record)
+
+class JSONFileSink(object):
+    """JSONFileSink(filename)
+    An Instrumentation sink that appends every CommandRecord to the file
+    'filename' as one line of JSON."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record.asDict()) + "\n"
+        with self._lock:
+            f = open(self.filename, 'a')
+            try:
+                f.write(line)
+            finally:
+                f.close()
+
+class Instrumentation(object):
+    """Instrumentation()
+    Times every command run through a Shell or AsyncShell, as well as the
+    setup of shared SSH connections, and keeps a LatencyHistogram of them
+    for each command family in 'histograms'.  The family is the program a
+    command runs unless the caller names one, as it does for compound
+    commands.  Every command of a Shell.executeMany() batch is recorded
+    under its own family, and the batch as a whole under 'executeMany'.
+    Every CommandRecord is also
+    passed to each sink added with addSink(), which may be a LogSink, a
+    JSONFileSink or any function taking one CommandRecord.  Set 'enabled'
+    to False to record nothing."""
+
+    def __init__(self):
+        self.enabled = True
+        self.histograms = {}
+        self._sinks = []
+        self._lock = threading.Lock()
+
+    def addSink(self, sink):
+        """addSink(sink)
+        Starts passing every new CommandRecord to the function 'sink'."""
+        with self._lock:
+            self._sinks.append(sink)
+
+    def removeSink(self, sink):
+        """removeSink(sink)
+        Stops passing records to 'sink'."""
+        with self._lock:
+            self._sinks.remove(sink)
+
+    def reset(self):
+        """reset()
+        Forgets all histograms."""
+        with self._lock:
+            self.histograms = {}
+
+    @staticmethod
+    def family(commandString):
+        """family(commandString) -> string
+        Returns the family of a command: the name of the program it runs."""
+        words = commandString.split(None, 1)
+        if not words:
+            return ""
+        return words[0].rpartition("/")[2]
+
+    def record(self, commandString, target, wallTime, bytesIn, bytesOut,
+               exitCode, family=None):
+        """record(commandString, target, wallTime, bytesIn, bytesOut, exitCode, family=None)
+        Records one finished command.  See CommandRecord."""
+        if not self.enabled:
+            return
+        if family is None:
+            family = self.family(commandString)
+        record = CommandRecord(commandString, family, target, wallTime,
+                               bytesIn, bytesOut, exitCode)
+        with self._lock:
+            if not family in self.histograms:
+                self.histograms[family] = LatencyHistogram()
+            self.histograms[family].add(wallTime)
+            sinks = list(self._sinks)
+        for sink in sinks:
+            sink(record)
+
+    def summary(self):
+        """summary() -> string
+        Returns a table of the count and latencies of every command family."""
+        lines = ["%-16s %7s %9s %9s %9s %9s" % ("family", "count", "mean",
+                                                 "p50", "p95", "max")]
+        with self._lock:
+            for family in sorted(self.histograms):
+                h = self.histograms[family]
+                lines.append("%-16s %7d %8.3fs %8.3fs %8.3fs %8.3fs" \
+                             % (family, h.count, h.mean(), h.percentile(50),
+                                h.percentile(95), h.max))
+        return "\n".join(lines)
+
+# Timing of every command run by this module
+instrumentation = Instrumentation()
+
+class SpillBuffer(object):
+    """SpillBuffer(maxMemory)
+    Collects bytes in memory until there are more than 'maxMemory' of them,
+    and from then on in an anonymous temporary file, so that output of any
+    size can be collected without running out of memory.  The collected
+    bytes can be read with file() or view() without copying them."""
+
+    def __init__(self, maxMemory):
+        self.maxMemory = maxMemory
+        self._file = BytesIO()
+        self._size = 0
+        self.spilled = False
+
+    def __len__(self):
+        return self._size
+
+    def write(self, data):
+        """write(data)
+        Adds the bytes 'data' to the end of the buffer."""
+        if not self.spilled and self._size + len(data) > self.maxMemory:
+            f = tempfile.TemporaryFile()
+            f.write(self._file.getbuffer())
+            self._file.close()
+            self._file = f
+            self.spilled = True
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(data)
+        self._size += len(data)
+
+    def getvalue(self):
+        """getvalue() -> bytes
+        Returns everything in the buffer as a single bytes object."""
+        if not self.spilled:
+            return self._file.getvalue()
+        self._file.seek(0)
+        return self._file.read()
+
+    def file(self):
+        """file() -> binary file object
+        Returns the file object holding the buffer (a BytesIO or a temporary
+        file), positioned at its start.  Closing it frees the buffer."""
+        self._file.flush()
+        self._file.seek(0)
+        return self._file
+
+    def view(self):
+        """view() -> memoryview
+        Returns a read-only view of the buffer without copying it.  A
+        buffer kept in a temporary file is memory-mapped instead of being
+        read.  Nothing may be written to the buffer while the view is in
+        use."""
+        if not self.spilled:
+            return self._file.getbuffer().toreadonly()
+        if self._size == 0:
+            return memoryview(b"")
+        self._file.flush()
+        return memoryview(mmap.mmap(self._file.fileno(), 0,
+                                    access=mmap.ACCESS_READ))
+
+    def close(self):
+        """close()
+        Frees the buffer."""
+        self._file.close()
+
 class Process(subprocess.Popen):
-    """Process(args)
+    """Process(args, encoding=None)
     This class masks the extra functionalities of 'subprocess.Popen' that
     just make it too confusing, including the fact that I/O is handled in
-    bytes instead of as a string."""
+    bytes instead of as a string.  The optional 'encoding' is used to convert
+    between the bytes the process sees and the strings this class returns.
+    By default, Process.defaultEncoding is used."""
 
-    def __init__(self, args):
+    # Encoding used when none is given, which maps every byte to one character
+    defaultEncoding = "latin-1"
+    # Output beyond this many bytes is collected in a temporary file
+    spillSize = 64 * 1024 * 1024
+
+    def __init__(self, args, encoding=None):
         self.args = args
+        if encoding is None:
+            encoding = self.defaultEncoding
+        self.charset = encoding
         subprocess.Popen.__init__(self, args,
                                   stdout=subprocess.PIPE, stdin=subprocess.PIPE,
                                   stderr=subprocess.STDOUT,
                                   shell=True, executable="/bin/sh")
-        self._savedOutput = ""
+        # Output saved by put() and finish(), not yet returned
+        self._savedOutput = SpillBuffer(self.spillSize)
+        # (commandString, target, family) to report to instrumentation, see
+        # Shell
+        self._instrumented = None
+        self._started = perf_counter()
+        self._bytesIn = 0
+        self._bytesOut = 0
+
+    def _finished(self):
+        """_finished()
+        Reports the finished process to the module's instrumentation if it
+        was started by a Shell, once."""
+        if self._instrumented is not None:
+            (commandString, target, family) = self._instrumented
+            self._instrumented = None
+            instrumentation.record(commandString, target,
+                                   perf_counter() - self._started,
+                                   self._bytesIn, self._bytesOut,
+                                   self.returncode, family)
 
     def __str__(self):
         s = self.poll()
@@ -141,18 +455,76 @@ class Process(subprocess.Popen):
             return "<Process (Running): " + str(self.args) + ">"
         return "<Process (Retval=" + str(s) + "): " + str(self.args) + ">"
 
-    def get(self, ignoreEmpty=False):
-        """get(ignoreEmpty=False) -> outputStr
-        Fetch the standard output of the process and return it as a normal
-        string.  Note that this method tells the process that it has reached
-        the end of any input from stdin.  This method will wait for the process
-        to end before returning the output.  If 'ignoreEmpty' is True, no error
-        messages will be printed."""
-        outBytes = bytes()
+    def _closeInput(self):
+        """_closeInput()
+        Tell the process that it has reached the end of its input without
+        waiting for it to finish."""
+        if self.stdin and not self.stdin.closed:
+            try:
+                self.stdin.close()
+            except OSError:
+                # The process already stopped reading its input
+                pass
+
+    def iterLines(self, encoding=None, keepEnds=False):
+        """iterLines(encoding=None, keepEnds=False) -> iterator of strings
+        Yield the standard output of the process one line at a time as soon
+        as each line is written, instead of waiting for the process to end.
+        Note that this method tells the process that it has reached the end of
+        any input from stdin, so call put() first if the process needs input.
+        Each line is decoded with 'encoding' (the process's encoding by
+        default) and has its line ending removed unless 'keepEnds' is True."""
+        if encoding is None:
+            encoding = self.charset
+        saved = self._takeSavedOutput()
+        # Output read by put() may end in the middle of a line
+        leftover = b""
+        for rawLine in saved.file():
+            if rawLine.endswith(b"\n"):
+                yield self._decodeLine(rawLine, encoding, keepEnds)
+            else:
+                leftover = rawLine
+        saved.close()
+        self._closeInput()
+        for rawLine in self.stdout:
+            self._bytesOut += len(rawLine)
+            if leftover:
+                rawLine = leftover + rawLine
+                leftover = b""
+            yield self._decodeLine(rawLine, encoding, keepEnds)
+        if leftover:
+            yield self._decodeLine(leftover, encoding, keepEnds)
+        self.wait()
+        self._finished()
+
+    def _decodeLine(self, rawLine, encoding, keepEnds):
+        """_decodeLine(rawLine, encoding, keepEnds) -> string
+        Decodes one line of output for iterLines()."""
+        line = rawLine.decode(encoding, "replace")
+        if not keepEnds:
+            line = line.rstrip("\r\n")
+        return line
+
+    def _takeSavedOutput(self):
+        """_takeSavedOutput() -> SpillBuffer
+        Returns (and forgets) the output saved by put() and finish()."""
+        retval = self._savedOutput
+        self._savedOutput = SpillBuffer(self.spillSize)
+        return retval
+
+    def _readInto(self, buffer, ignoreEmpty=False):
+        """_readInto(buffer, ignoreEmpty=False)
+        Tells the process that it has reached the end of its input, then
+        writes the rest of its output to the SpillBuffer 'buffer' piece by
+        piece and waits for it to finish.  If the output was already read,
+        an error message is printed unless 'ignoreEmpty' is True."""
+        self._closeInput()
         try:
-            # Flushes stdin, closes stdin, waits for the process to finish,
-            # and reads stdout
-            (outBytes, errBytes) = subprocess.Popen.communicate(self)
+            chunk = self.stdout.read1(65536)
+            while chunk:
+                self._bytesOut += len(chunk)
+                buffer.write(chunk)
+                chunk = self.stdout.read1(65536)
         except ValueError:
             if not ignoreEmpty:
                 print("get: end of output.  Pid", self.pid, "is probably dead.",
@@ -161,22 +533,138 @@ class Process(subprocess.Popen):
                     print("get: Yup, pid", self.pid, "died a while ago.",
                         "Its final words were the retval",
                         str(self.poll()) + ".", file=sys.stderr)
-        charString = ""
-        for c in outBytes:
-            charString += chr(c)
-        retval = self._savedOutput + charString.strip()
-        self._savedOutput = ""
+        self.wait()
+        self._finished()
+
+    def _collectOutput(self, ignoreEmpty=False):
+        """_collectOutput(ignoreEmpty=False) -> SpillBuffer
+        Returns a SpillBuffer holding the saved output followed by the rest
+        of the output of the process, after it finished."""
+        buffer = self._takeSavedOutput()
+        self._readInto(buffer, ignoreEmpty)
+        return buffer
+
+    def iterChunks(self, size=65536, encoding=None):
+        """iterChunks(size=65536, encoding=None) -> iterator of strings
+        Yield the standard output of the process in pieces of at most 'size'
+        bytes as soon as they are available, instead of waiting for the
+        process to end.  Multi-byte characters split between two pieces are
+        decoded correctly.  Like iterLines(), this method tells the process
+        that it has reached the end of any input from stdin."""
+        if encoding is None:
+            encoding = self.charset
+        decoder = codecs.getincrementaldecoder(encoding)("replace")
+        saved = self._takeSavedOutput()
+        savedFile = saved.file()
+        chunk = savedFile.read(size)
+        while chunk:
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+            chunk = savedFile.read(size)
+        saved.close()
+        self._closeInput()
+        chunk = self.stdout.read1(size)
+        while chunk:
+            self._bytesOut += len(chunk)
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+            chunk = self.stdout.read1(size)
+        text = decoder.decode(b"", True)
+        if text:
+            yield text
+        self.wait()
+        self._finished()
+
+    def outputStream(self):
+        """outputStream() -> binary file object
+        Returns a file object that reads the rest of the standard output of
+        the process as bytes, as it is produced, starting with any output
+        put() or finish() already read.  Like iterLines(), this method tells
+        the process that it has reached the end of any input from stdin."""
+        self._closeInput()
+        return io.BufferedReader(_OutputReader(self,
+                                               self._takeSavedOutput().file()))
+
+    def get(self, ignoreEmpty=False, encoding=None):
+        """get(ignoreEmpty=False, encoding=None) -> outputStr
+        Fetch the standard output of the process and return it as a normal
+        string.  Note that this method tells the process that it has reached
+        the end of any input from stdin.  This method will wait for the process
+        to end before returning the output.  If 'ignoreEmpty' is True, no error
+        messages will be printed.  The output is decoded with 'encoding', or
+        with the process's encoding if none is given."""
+        if encoding is None:
+            encoding = self.charset
+        buffer = self._collectOutput(ignoreEmpty)
+        retval = buffer.getvalue().decode(encoding, "replace").strip()
+        buffer.close()
         return retval
 
+    def getFile(self, ignoreEmpty=False):
+        """getFile(ignoreEmpty=False) -> binary file object
+        Like getBytes(), but returns the output as a file object positioned
+        at its start.  Output beyond Process.spillSize bytes is written to a
+        temporary file instead of being kept in memory, so output of any
+        size can be fetched.  Close the file object when done with it."""
+        return self._collectOutput(ignoreEmpty).file()
+
+    def getView(self, ignoreEmpty=False):
+        """getView(ignoreEmpty=False) -> memoryview
+        Like getBytes(), but returns a read-only view of the output that is
+        never copied.  Output beyond Process.spillSize bytes is written to a
+        temporary file, which the view maps into memory."""
+        return self._collectOutput(ignoreEmpty).view()
+
     def put(self, input):
         """put(string)
-        Pass the string 'input' as the standard input to the process."""
-        intInput = [ord(c) for c in input]
-        byteInput = bytes(intInput)
+        Pass the string (or bytes) 'input' as the standard input to the
+        process.  Any output the process writes in the meantime is read and
+        saved for get(), so that neither side can get stuck waiting for the
+        other no matter how much is written.  Like the output saved by
+        finish(), output beyond Process.spillSize bytes is saved to a
+        temporary file instead of memory."""
+        if isinstance(input, str):
+            byteInput = input.encode(self.charset)
+        else:
+            byteInput = input
+        self._bytesIn += len(byteInput)
         try:
-            self.stdin.write(byteInput)
-        except ValueError:
+            self.stdin.flush()
+            inFd = self.stdin.fileno()
+        except (ValueError, AttributeError):
             raise TalkingToDeadError(self.pid)
+        view = memoryview(byteInput)
+        written = 0
+        selector = selectors.DefaultSelector()
+        os.set_blocking(inFd, False)
+        try:
+            selector.register(inFd, selectors.EVENT_WRITE)
+            if not self.stdout.closed:
+                selector.register(self.stdout.fileno(), selectors.EVENT_READ)
+            while written < len(view):
+                for (key, events) in selector.select():
+                    if key.fd == inFd:
+                        try:
+                            written += os.write(inFd,
+                                                view[written:written + 65536])
+                        except BlockingIOError:
+                            pass
+                        except BrokenPipeError:
+                            raise TalkingToDeadError(self.pid)
+                    else:
+                        # Make room in the output pipe so the process can go
+                        # on reading its input
+                        chunk = os.read(key.fd, 65536)
+                        if chunk:
+                            self._bytesOut += len(chunk)
+                            self._savedOutput.write(chunk)
+                        else:
+                            selector.unregister(key.fd)
+        finally:
+            selector.close()
+            os.set_blocking(inFd, True)
 
     def getBytes(self, ignoreEmpty=False):
         """getBytes(ignoreEmpty=False) -> outputBytes
@@ -184,22 +672,11 @@ class Process(subprocess.Popen):
         object.  Note that this method tells the process that it has reached
         the end of any input from stdin.  This method will wait for the process
         to end before returning the output.  If 'ignoreEmpty' is True, no error
-        messages will be printed."""
-        outBytes = bytes()
-        try:
-            # Flushes stdin, closes stdin, waits for the process to finish,
-            # and reads stdout
-            (outBytes, errBytes) = subprocess.Popen.communicate(self)
-        except ValueError:
-            if not ignoreEmpty:
-                print("get: end of output.  Pid", self.pid, "is probably dead.",
-                    file=sys.stderr)
-                if not self.poll() is None:
-                    print("get: Yup, pid", self.pid, "died a while ago.",
-                        "Its final words were the retval",
-                        str(self.poll()) + ".", file=sys.stderr)
-        retval = bytes(self._savedOutput, 'ascii') + outBytes
-        self._savedOutput = ""
+        messages will be printed.  For large output, consider getFile() or
+        getView() instead."""
+        buffer = self._collectOutput(ignoreEmpty)
+        retval = buffer.getvalue()
+        buffer.close()
         return retval
 
     def finish(self):
@@ -207,8 +684,9 @@ class Process(subprocess.Popen):
         Notify the process that you are done entering input into stdin.
         Wait for the proess to finish and then return.  Any resulting output
         will be saved to the object and can be read later with the get()
-        function."""
-        self._savedOutput += self.get(True)
+        function.  Output beyond Process.spillSize bytes is saved to a
+        temporary file instead of memory."""
+        self._readInto(self._savedOutput, True)
 
     def terminate(self):
         """terminate()
@@ -228,18 +706,80 @@ class Process(subprocess.Popen):
         except OSError:
             print("kill: pid", self.pid, "is already dead.", file=sys.stderr)
 
+class _OutputReader(io.RawIOBase):
+    """_OutputReader(process, saved)
+    The raw file object behind Process.outputStream(): the rest of the
+    binary file object 'saved' followed by the rest of the standard output
+    of 'process'.  'saved' is closed once it has been read."""
+
+    def __init__(self, process, saved):
+        io.RawIOBase.__init__(self)
+        self._process = process
+        self._saved = saved
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._saved is not None:
+            n = self._saved.readinto(buffer)
+            if n:
+                return n
+            self._saved.close()
+            self._saved = None
+        chunk = self._process.stdout.read1(len(buffer))
+        if not chunk:
+            # End of output
+            self._process.wait()
+            self._process._finished()
+            return 0
+        self._process._bytesOut += len(chunk)
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+class _InputWriter(io.RawIOBase):
+    """_InputWriter(process)
+    A raw file object that writes to the standard input of 'process' with
+    Process.put()."""
+
+    def __init__(self, process):
+        io.RawIOBase.__init__(self)
+        self._process = process
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._process.put(bytes(data))
+        return len(data)
+
 class Shell(object):
-    """Shell(remoteServer=None, remoteUser=None)
+    """Shell(remoteServer=None, remoteUser=None, multiplex=True)
     This class abstracts away the difference between running a command locally
     or though an SSH session.  It creates a shell with which commands can be
     executed.  If 'remoteServer' is 'None' or 'localhost', the commands are
     executed on the local machine and 'remoteUser' does not need to be
     supplied.  Otherwise, the commands are executed on a remote machine
     "remoteServer" as the user "remoteUser" via an SSH session.  If no
-    'remoteUser' is specified, the the local username is used."""
+    'remoteUser' is specified, the the local username is used.  If 'multiplex'
+    is True, all remote shells for the same user and server share one
+    persistent SSH connection (an SSH "ControlMaster"), so only the first
+    command pays for the SSH handshake."""
 
-    def __init__(self, remoteServer=None, remoteUser=None):
+    # Number of seconds an idle shared SSH connection is kept open
+    controlPersist = 600
+    # Directory holding the control sockets of the shared SSH connections
+    _controlDir = None
+    # "user@server" -> control socket path of its shared SSH connection
+    _controlPaths = {}
+    # "user@server" -> True once its shared SSH connection has been started
+    _masters = {}
+    # Keeps shells in several threads from starting the same connection
+    _masterLock = threading.Lock()
+
+    def __init__(self, remoteServer=None, remoteUser=None, multiplex=True):
         self.local = remoteServer is None or remoteServer.lower() == "localhost"
+        self.multiplex = multiplex
         if self.local:
             # Run commands directly
             self.remoteServer = None
@@ -248,7 +788,7 @@ class Shell(object):
             # Run commands in an SSH session
             self.remoteServer = remoteServer
             if remoteUser is None:
-                self.remoteUser = Process("whoami").get().strip()
+                self.remoteUser = _localEnvironment()["username"]
             else:
                 self.remoteUser = remoteUser
 
@@ -261,35 +801,303 @@ class Shell(object):
                + shellType \
                + ">"
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+    def _target(self):
+        """_target() -> string
+        Returns the "user@server" string that SSH uses to reach the remote
+        machine."""
+        if self.remoteUser:
+            # remoteUser is defined and non-empty
+            return str(self.remoteUser) + "@" + str(self.remoteServer)
+        return str(self.remoteServer)
+
+    def _controlPath(self):
+        """_controlPath() -> string
+        Returns the path of the control socket shared by every multiplexed
+        shell connected to the same user and server."""
+        target = self._target()
+        if not target in Shell._controlPaths:
+            if Shell._controlDir is None:
+                Shell._controlDir = tempfile.mkdtemp(prefix="condorssh-")
+                atexit.register(Shell.closeAll)
+            Shell._controlPaths[target] = os.path.join(Shell._controlDir,
+                    str(len(Shell._controlPaths)))
+        return Shell._controlPaths[target]
+
+    def _sshCommand(self, options=""):
+        """_sshCommand(options="") -> sshCommandString
+        Returns the SSH command (without a remote command) used to reach the
+        remote machine, including any extra 'options'."""
+        retval = "ssh "
+        if self.multiplex:
+            retval += "-o ControlMaster=no -o ControlPath=" \
+                      + shlex.quote(self._controlPath()) + " "
+        if options:
+            retval += options + " "
+        return retval + shlex.quote(self._target())
+
+    def _masterAlive(self):
+        """_masterAlive() -> boolean
+        Returns whether the shared SSH connection for this shell is up."""
+        return subprocess.call(self._sshCommand("-O check"), shell=True,
+                               stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL) == 0
+
+    def _startMaster(self):
+        """_startMaster() -> boolean
+        Starts the shared SSH connection for this shell in the background,
+        replacing a dead one if necessary.  Returns whether it is now up.  If
+        the connection cannot be made, commands simply fall back to opening
+        their own SSH connections."""
+        target = self._target()
+        controlPath = self._controlPath()
+        if os.path.exists(controlPath):
+            # Stale socket left over from a connection that went away
+            os.remove(controlPath)
+        started = perf_counter()
+        status = subprocess.call("ssh -f -N -o ControlMaster=yes" \
+                                 + " -o ControlPersist=" \
+                                 + str(self.controlPersist) \
+                                 + " -o ControlPath=" \
+                                 + shlex.quote(controlPath) + " " \
+                                 + shlex.quote(target), shell=True,
+                                 stdin=subprocess.DEVNULL,
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL)
+        instrumentation.record("ssh -f -N " + target, target,
+                               perf_counter() - started, 0, 0, status,
+                               "ssh connect")
+        Shell._masters[target] = status == 0
+        return Shell._masters[target]
+
+    def _restartMaster(self):
+        """_restartMaster() -> boolean
+        Starts the shared SSH connection for this shell again if it is
+        down, unless another thread already did.  Returns whether it is
+        up."""
+        with Shell._masterLock:
+            if self._masterAlive():
+                return True
+            return self._startMaster()
+
+    def _ensureMaster(self):
+        """_ensureMaster()
+        Makes sure the shared SSH connection has been started once before
+        the first command is run through it."""
+        if not self.local and self.multiplex \
+                and not self._target() in Shell._masters:
+            with Shell._masterLock:
+                if not self._target() in Shell._masters:
+                    self._startMaster()
+
+    def close(self):
+        """close()
+        Closes the shared SSH connection used by this shell, if any.  Any
+        other shells connected to the same user and server will transparently
+        open a new one the next time they are used."""
+        if self.local or not self.multiplex:
+            return
+        target = self._target()
+        if Shell._masters.pop(target, False):
+            subprocess.call(self._sshCommand("-O exit"), shell=True,
+                            stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+
+    @staticmethod
+    def closeAll():
+        """closeAll()
+        Closes every shared SSH connection and removes their control sockets.
+        This is run automatically when Python exits."""
+        for target in list(Shell._masters):
+            user, _, server = target.rpartition("@")
+            Shell(server, user or None).close()
+        if Shell._controlDir is not None:
+            shutil.rmtree(Shell._controlDir, True)
+            Shell._controlDir = None
+            Shell._controlPaths.clear()
+
     def _buildFullCommand(self, commandString):
         """_buildFullCommand(commandString) -> fullCommandString
         Given the 'commandString', a full command string is returned based
         on whether the shell is local or not.  If the shell is not local, the
         SSH command is prefixed to it and returned.  If the shell is local,
-        the supplied 'commandString' is simlpy returned."""
+        the supplied 'commandString' is simlpy returned.  The remote command
+        is quoted so that the remote shell sees exactly 'commandString'."""
         if self.local:
             return commandString
         else:
-            retval = "ssh "
-            if self.remoteUser:
-                # remoteUser is defined and non-empty
-                retval += str(self.remoteUser) + "@"
-            return retval + str(self.remoteServer) + " " + commandString
-
-    def execute(self, commandString, inputStr=None, returnBytes=False):
-        """execute(commandString, inputStr=None, returnBytes=False) -> (returnValue, outputStr)
+            self._ensureMaster()
+            return self._sshCommand() + " " + shlex.quote(commandString)
+
+    def _run(self, commandString, inputStr, read, family=None):
+        """_run(commandString, inputStr, read, family=None) -> (returnValue, output)
+        Run the given 'commandString' once and return its result, with its
+        output fetched by the Process method 'read'."""
+        p = self.spawn(commandString, False, family)
+        if not inputStr is None:
+            p.put(inputStr)
+        s = read(p)
+        return (p.poll(), s)
+
+    def _runRetrying(self, commandString, inputStr, read, idempotent=False,
+                     family=None):
+        """_runRetrying(commandString, inputStr, read, idempotent=False, family=None) -> (returnValue, output)
+        Like _run(), but makes up for a dead shared SSH connection.  If
+        'idempotent' is True and the connection turns out to have died during
+        the command, it is reopened and the command is run again.  Otherwise
+        the command may already have run on the remote side, so it is never
+        run twice; instead the connection is checked (and reopened if
+        needed) before the command starts."""
+        multiplexed = not self.local and self.multiplex
+        if multiplexed and not idempotent \
+                and Shell._masters.get(self._target()) \
+                and not self._masterAlive():
+            self._restartMaster()
+        (retval, s) = self._run(commandString, inputStr, read, family)
+        if idempotent and retval == 255 and multiplexed \
+                and not self._masterAlive():
+            # SSH itself failed, so reconnect and try again
+            self._restartMaster()
+            (retval, s) = self._run(commandString, inputStr, read, family)
+        return (retval, s)
+
+    def execute(self, commandString, inputStr=None, returnBytes=False,
+                idempotent=False, family=None):
+        """execute(commandString, inputStr=None, returnBytes=False, idempotent=False, family=None) -> (returnValue, outputStr)
         Execute the given 'commandString' in a non-interactive shell.  The
         shell will wait for the process to finish before printing its output,
         if any.  If 'input' is supplied as a string, it is supplied to the
-        process at runtime."""
-        p = Process(self._buildFullCommand(commandString))
+        process at runtime.  A dead shared SSH connection of a remote shell
+        is reopened before the command runs.  Only if 'idempotent' is True,
+        meaning running the command twice does no harm, is the command also
+        retried when the connection dies while it runs.  The command is
+        recorded by the module's instrumentation under 'family', or under
+        the name of the program it runs if 'family' is None."""
+        if returnBytes:
+            return self._runRetrying(commandString, inputStr, Process.getBytes,
+                                     idempotent, family)
+        return self._runRetrying(commandString, inputStr, Process.get,
+                                 idempotent, family)
+
+    def executeFile(self, commandString, inputStr=None, idempotent=False,
+                    family=None):
+        """executeFile(commandString, inputStr=None, idempotent=False, family=None) -> (returnValue, outputFile)
+        Like execute(), but returns the output as a binary file object (see
+        Process.getFile()), so that output larger than Process.spillSize is
+        never held in memory.  Close the file object when done with it."""
+        return self._runRetrying(commandString, inputStr, Process.getFile,
+                                 idempotent, family)
+
+    def executeMany(self, commandStrings, returnBytes=False, idempotent=False):
+        """executeMany(commandStrings, returnBytes=False, idempotent=False) -> [(returnValue, outputStr), ...]
+        Execute every command in the list 'commandStrings' one after another
+        using a single process (and so a single SSH round trip for a remote
+        shell), and return the result of each command separately, in order,
+        just like execute() would have.  The commands do not get any input.
+        If the batch fails before every command has reported back, the
+        remaining commands get the return value of the batch itself and the
+        first of them gets whatever output was left over.  See execute() for
+        'idempotent'.  Each command is recorded by the module's
+        instrumentation under its own family, timed by the clock of the
+        machine running it."""
+        commandStrings = list(commandStrings)
+        if not commandStrings:
+            return []
+        # Every command's output is followed by a line holding this marker,
+        # the command's return value and the time it finished.  The first
+        # such line, with '-' for a return value, marks the start.
+        marker = "--condor-py-" + uuid.uuid4().hex + "--"
+        stamp = " \"$(date +%s.%N)\"\n"
+        script = ["printf '%s - %s\\n' " + marker + stamp]
+        for commandString in commandStrings:
+            script.append("(" + commandString + ") </dev/null 2>&1\n")
+            script.append("printf '\\n%s %d %s\\n' " + marker + " $?"
+                          + stamp)
+        started = perf_counter()
+        (batchRetval, outBytes) = self.execute("/bin/sh", "".join(script),
+                                               True, idempotent, "executeMany")
+        batchTime = perf_counter() - started
+        pieces = re.split(b"\n?" + marker.encode("ascii")
+                          + b" (-|\\d+) (\\S*)\n", outBytes)
+        times = [self._parseStamp(pieces[2])] if len(pieces) > 3 else []
+        results = []
+        for i in range(3, len(pieces) - 1, 3):
+            results.append((int(pieces[i + 1]), pieces[i]))
+            times.append(self._parseStamp(pieces[i + 2]))
+        leftover = pieces[-1]
+        target = self._instrumentTarget()
+        for (i, (retval, out)) in enumerate(results):
+            if times[i] is None or times[i + 1] is None:
+                # The remote 'date' cannot tell, so share out the batch
+                wallTime = batchTime / len(commandStrings)
+            else:
+                wallTime = max(0.0, times[i + 1] - times[i])
+            instrumentation.record(commandStrings[i], target, wallTime, 0,
+                                   len(out), retval)
+        while len(results) < len(commandStrings):
+            results.append((batchRetval, leftover))
+            leftover = b""
+        if returnBytes:
+            return results
+        return [(retval, out.decode(Process.defaultEncoding).strip())
+                for (retval, out) in results]
+
+    @staticmethod
+    def _parseStamp(stamp):
+        """_parseStamp(stamp) -> float or None
+        Returns the time printed by 'date +%s.%N' in executeMany(), or None
+        if that 'date' did not understand the format."""
+        try:
+            return float(stamp)
+        except ValueError:
+            return None
+
+    def executeLines(self, commandString, inputStr=None):
+        """executeLines(commandString, inputStr=None) -> iterator of strings
+        Execute the given 'commandString' in a non-interactive shell and yield
+        its output one line at a time while the process is still running, so
+        large outputs can be parsed without being held in memory all at once.
+        If 'input' is supplied as a string, it is supplied to the process at
+        runtime.  Callers that also need the return value of the process
+        should use spawn() and call iterLines() on the Process themselves."""
+        p = self.spawn(commandString)
         if not inputStr is None:
             p.put(inputStr)
-        if returnBytes:
-            s = p.getBytes()
-        else:
-            s = p.get()
-        return (p.poll(), s)
+        for line in p.iterLines():
+            yield line
+
+    def spawn(self, commandString, quiet=False, family=None):
+        """spawn(commandString, quiet=False, family=None) -> Process
+        Start the given 'commandString' in a non-interactive shell and return
+        the running Process without waiting for it to finish.  Once its
+        output has been read, the command is reported to the module's
+        instrumentation, under 'family' if given (see execute()).  If 'quiet'
+        is True, error messages (including those of SSH itself) are thrown
+        away instead of mixed into the output."""
+        fullCommand = self._buildFullCommand(commandString)
+        if not self.local:
+            # So that killing the Process kills SSH, not just /bin/sh
+            fullCommand = "exec " + fullCommand
+        if quiet:
+            fullCommand += " 2>/dev/null"
+        p = Process(fullCommand)
+        p._instrumented = (commandString, self._instrumentTarget(), family)
+        return p
+
+    def _instrumentTarget(self):
+        """_instrumentTarget() -> string
+        Returns where commands of this shell run, for instrumentation."""
+        if self.local:
+            return "local"
+        return self._target()
 
     def executeInteractive(self, commandString):
         """executeInteractive(commandString)
@@ -297,7 +1105,7 @@ class Shell(object):
         process needs input the user will be prompted to supply it.  If the
         output is delayed, the user will be prompted to manually poll for it.
         The user is also given the option of killing the process."""
-        p = Process(self._buildFullCommand(commandString))
+        p = self.spawn(commandString)
         if not p.poll() is None:
             # The program finished quickly, so just print the output.
             print(p.get())
@@ -327,52 +1135,1440 @@ following options:
   help: This text.""" \
                 )
 
+async def _runInThread(function, *args):
+    """_runInThread(function, *args) -> return value
+    A coroutine that calls 'function' with 'args' in the default executor
+    of the running event loop, for blocking work such as opening an SSH
+    connection, so that other tasks can run meanwhile."""
+    return await asyncio.get_running_loop().run_in_executor(None, function,
+                                                            *args)
+
+class AsyncShell(object):
+    """AsyncShell(remoteServer=None, remoteUser=None, multiplex=True, maxConcurrent=None)
+    The asyncio counterpart of Shell.  Its execute() method is a coroutine, so
+    many commands (for example, those of many Jobs) can run at the same time
+    from a single event loop.  The arguments are the same as for Shell.  If
+    'maxConcurrent' is given, no more than that many commands started through
+    this shell run at once; the rest wait for their turn."""
+
+    def __init__(self, remoteServer=None, remoteUser=None, multiplex=True,
+                 maxConcurrent=None):
+        self.shell = Shell(remoteServer, remoteUser, multiplex)
+        self.maxConcurrent = maxConcurrent
+        self._semaphore = None
+
+    @classmethod
+    def fromShell(cls, shell, maxConcurrent=None):
+        """fromShell(shell, maxConcurrent=None) -> AsyncShell
+        Returns an AsyncShell that runs its commands wherever the given
+        Shell 'shell' does."""
+        retval = cls.__new__(cls)
+        retval.shell = shell
+        retval.maxConcurrent = maxConcurrent
+        retval._semaphore = None
+        return retval
+
+    def __str__(self):
+        return "<Async" + str(self.shell)[1:]
+
+    def _getSemaphore(self):
+        """_getSemaphore() -> asyncio.Semaphore or None
+        Returns the semaphore limiting the number of running commands,
+        creating it inside the running event loop the first time."""
+        if self._semaphore is None and self.maxConcurrent:
+            self._semaphore = asyncio.Semaphore(self.maxConcurrent)
+        return self._semaphore
+
+    async def _run(self, commandString, inputStr=None, returnBytes=False,
+                   family=None):
+        """_run(commandString, inputStr=None, returnBytes=False, family=None) -> (returnValue, output)
+        Run the given 'commandString' once and return its result."""
+        if not self.shell.local and self.shell.multiplex \
+                and not self.shell._target() in Shell._masters:
+            # Opening the shared SSH connection blocks, so do it elsewhere
+            await _runInThread(self.shell._ensureMaster)
+        started = perf_counter()
+        p = await asyncio.create_subprocess_shell(
+                self.shell._buildFullCommand(commandString),
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT, executable="/bin/sh")
+        if inputStr is None:
+            inBytes = None
+        else:
+            inBytes = inputStr.encode(Process.defaultEncoding)
+        (outBytes, errBytes) = await p.communicate(inBytes)
+        instrumentation.record(commandString, self.shell._instrumentTarget(),
+                               perf_counter() - started,
+                               len(inBytes or b""), len(outBytes),
+                               p.returncode, family)
+        if returnBytes:
+            return (p.returncode, outBytes)
+        return (p.returncode,
+                outBytes.decode(Process.defaultEncoding, "replace").strip())
+
+    async def execute(self, commandString, inputStr=None, returnBytes=False,
+                      idempotent=False, family=None):
+        """execute(commandString, inputStr=None, returnBytes=False, idempotent=False, family=None) -> (returnValue, outputStr)
+        A coroutine that executes the given 'commandString' in a
+        non-interactive shell without blocking the event loop.  Otherwise it
+        behaves exactly like Shell.execute()."""
+        semaphore = self._getSemaphore()
+        if semaphore is not None:
+            await semaphore.acquire()
+        try:
+            shell = self.shell
+            multiplexed = not shell.local and shell.multiplex
+            if multiplexed and not idempotent \
+                    and Shell._masters.get(shell._target()) \
+                    and not await _runInThread(shell._masterAlive):
+                await _runInThread(shell._restartMaster)
+            (retval, s) = await self._run(commandString, inputStr, returnBytes,
+                                          family)
+            if idempotent and retval == 255 and multiplexed \
+                    and not await _runInThread(shell._masterAlive):
+                # SSH itself failed, so reconnect and try again
+                await _runInThread(shell._restartMaster)
+                (retval, s) = await self._run(commandString, inputStr,
+                                              returnBytes, family)
+            return (retval, s)
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+class EnvironmentCache(object):
+    """EnvironmentCache(filename=None, ttl=3600.0)
+    Remembers the answers to questions about the environment, such as the
+    local username or whether 'condor_submit' is installed, so that they are
+    only asked once per Python process no matter how many Jobs need them.
+    If 'filename' is given, the answers are also saved in that JSON file and
+    reused by later Python processes for 'ttl' seconds."""
+
+    def __init__(self, filename=None, ttl=3600.0):
+        self._values = {}
+        self._lock = threading.RLock()
+        # key -> Lock held while its probe runs
+        self._probing = {}
+        self.setFile(filename, ttl)
+
+    def setFile(self, filename, ttl=3600.0):
+        """setFile(filename, ttl=3600.0)
+        Starts (or, if 'filename' is None, stops) saving answers to the JSON
+        file 'filename', where they stay valid for 'ttl' seconds."""
+        with self._lock:
+            self.filename = filename
+            self.ttl = ttl
+            self._fileValues = None
+
+    def _readFile(self):
+        """_readFile() -> dictionary
+        Returns the unexpired answers saved in the cache file, if any."""
+        if self._fileValues is None:
+            self._fileValues = {}
+            try:
+                f = open(self.filename, 'r')
+                try:
+                    saved = json.load(f)
+                finally:
+                    f.close()
+            except (IOError, OSError, ValueError):
+                saved = {}
+            now = time()
+            for key in saved:
+                (savedTime, value) = saved[key]
+                if now - savedTime < self.ttl:
+                    self._fileValues[key] = (savedTime, value)
+        return self._fileValues
+
+    def _writeFile(self):
+        """_writeFile()
+        Saves the answers to the cache file without ever leaving a half
+        written file behind."""
+        tempName = self.filename + "." + str(os.getpid()) + ".tmp"
+        try:
+            f = open(tempName, 'w')
+            try:
+                json.dump(self._fileValues, f)
+            finally:
+                f.close()
+            os.replace(tempName, self.filename)
+        except (IOError, OSError):
+            print("Warning: Could not save the environment cache to",
+                  self.filename, file=sys.stderr)
+
+    def get(self, key, probe):
+        """get(key, probe) -> value
+        Returns the answer saved under the string 'key'.  If there is none
+        yet, the function 'probe' is called with no arguments to find it out
+        and its (JSON-compatible) return value is saved and returned.  A
+        probe that fails should return None, which is returned but not saved,
+        so that the next call probes again.  While one thread probes, other
+        threads only wait if they need the same key."""
+        with self._lock:
+            if key in self._values:
+                return self._values[key]
+            if self.filename is not None and key in self._readFile():
+                value = self._fileValues[key][1]
+                self._values[key] = value
+                return value
+            keyLock = self._probing.setdefault(key, threading.Lock())
+        with keyLock:
+            with self._lock:
+                if key in self._values:
+                    # Another thread probed it meanwhile
+                    return self._values[key]
+            value = probe()
+            if value is None:
+                return None
+            with self._lock:
+                if self.filename is not None:
+                    self._readFile()[key] = (time(), value)
+                    self._writeFile()
+                self._values[key] = value
+                self._probing.pop(key, None)
+        return value
+
+    def invalidate(self, key=None):
+        """invalidate(key=None)
+        Forgets the answer saved under 'key', or every answer if 'key' is
+        None, so that it is found out again the next time it is needed."""
+        with self._lock:
+            if key is None:
+                self._values.clear()
+                if self.filename is not None:
+                    self._fileValues = {}
+            else:
+                self._values.pop(key, None)
+                if self.filename is not None:
+                    self._readFile().pop(key, None)
+            if self.filename is not None:
+                self._writeFile()
+
+# Answers to environment questions shared by every Job in this process
+environment = EnvironmentCache()
+
+def _probeLocalEnvironment():
+    """_probeLocalEnvironment() -> dictionary
+    Looks up the local username and whether 'condor_submit' is installed
+    locally with a single process."""
+    ((whoamiStatus, whoami), (whichStatus, which)) = \
+            Shell().executeMany(["whoami", "which condor_submit"])
+    if whoamiStatus != 0:
+        # Not saved, so it is probed again next time
+        return None
+    return {"username": whoami.strip(), "condorSubmit": whichStatus == 0}
+
+def _localEnvironment():
+    """_localEnvironment() -> dictionary
+    Returns the (cached) local username as "username" and whether
+    'condor_submit' is installed locally as "condorSubmit".  If the
+    username cannot be found out, it is None and 'condor_submit' is not
+    used locally."""
+    value = environment.get("local", _probeLocalEnvironment)
+    if value is None:
+        return {"username": None, "condorSubmit": False}
+    return value
+
+class UserLog(object):
+    """UserLog(path, shell=None)
+    Follows the Condor user log at 'path' (see Job.setLog()) as Condor writes
+    to it, keeping track of the last event of every process.  Each call to
+    read() only reads what was added since the previous call.  If 'shell' is
+    a remote Shell, the log is followed with one 'tail' process over SSH that
+    stays running until close() is called."""
+
+    SUBMIT = 0
+    EXECUTE = 1
+    TERMINATED = 5
+    ABORTED = 9
+    HELD = 12
+    RELEASED = 13
+    # Events after which a process is no longer in the queue
+    FINISHED = (TERMINATED, ABORTED)
+    # First line of every event, e.g. "005 (123.004.000) 10/16 12:00:00 ..."
+    _eventRE = re.compile(r"^(\d{3}) \((\d+)\.(\d+)\.\d+\) ")
+    # How a process ended, in the lines of its TERMINATED event
+    _terminationRE = re.compile(r"^\s*\(\d+\) (?:Normal termination " \
+                                + r"\(return value (\d+)\)|Abnormal termination)")
+
+    def __init__(self, path, shell=None):
+        self.path = path
+        if shell is None:
+            shell = Shell()
+        self.shell = shell
+        # (cluster, proc) -> number of the last event seen for it
+        self.states = {}
+        # (cluster, proc) -> return value of every finished process, None if
+        # it was aborted or killed by a signal
+        self.returnValues = {}
+        # (cluster, proc) of the TERMINATED event being read, if any
+        self._terminated = None
+        self._offset = 0
+        self._partialLine = b""
+        self._tail = None
+        self._tailLines = None
+
+    def __del__(self):
+        self.close()
+
+    def _readLocal(self):
+        """_readLocal() -> [line, ...]
+        Returns the complete lines added to the local log file since the
+        last call."""
+        try:
+            f = open(self.path, 'rb')
+        except (IOError, OSError):
+            # Condor has not created the log yet
+            return []
+        try:
+            f.seek(self._offset)
+            data = f.read()
+        finally:
+            f.close()
+        self._offset += len(data)
+        lines = (self._partialLine + data).split(b"\n")
+        self._partialLine = lines.pop()
+        return [line.decode(Process.defaultEncoding) for line in lines]
+
+    def _readRemote(self):
+        """_readRemote() -> [line, ...]
+        Returns the lines received from the remote 'tail' since the last
+        call, starting it the first time."""
+        if self._tail is None:
+            # 'tail' is stopped as soon as its input ends, which happens when
+            # close() closes it or the SSH connection goes away, so that it
+            # never outlives this object on the remote machine
+            self._tail = self.shell.spawn("tail -c +1 -F " \
+                                          + shlex.quote(self.path) \
+                                          + " 2>/dev/null & read x; kill $!")
+            self._tailLines = Queue()
+            def pump(process, lines):
+                # Not iterLines(), which would end the input of 'tail'
+                for rawLine in process.stdout:
+                    lines.put(process._decodeLine(rawLine, process.charset,
+                                                  False))
+            reader = threading.Thread(target=pump,
+                                      args=(self._tail, self._tailLines))
+            reader.daemon = True
+            reader.start()
+        lines = []
+        try:
+            while True:
+                lines.append(self._tailLines.get_nowait())
+        except Empty:
+            pass
+        return lines
+
+    def read(self):
+        """read() -> [(event_int, cluster_int, proc_int), ...]
+        Reads the events added to the log since the last call, updates
+        'states' and 'returnValues' and returns the new events in order."""
+        if self.shell.local:
+            lines = self._readLocal()
+        else:
+            lines = self._readRemote()
+        events = []
+        for line in lines:
+            match = self._eventRE.match(line)
+            if match is not None:
+                event = (int(match.group(1)), int(match.group(2)),
+                         int(match.group(3)))
+                self.states[(event[1], event[2])] = event[0]
+                events.append(event)
+                self._terminated = None
+                if event[0] == self.TERMINATED:
+                    self._terminated = (event[1], event[2])
+                elif event[0] == self.ABORTED:
+                    self.returnValues[(event[1], event[2])] = None
+                continue
+            match = self._terminationRE.match(line)
+            if match is not None and self._terminated is not None:
+                if match.group(1) is None:
+                    self.returnValues[self._terminated] = None
+                else:
+                    self.returnValues[self._terminated] = int(match.group(1))
+                self._terminated = None
+        return events
+
+    def remaining(self, clusters, expected=None):
+        """remaining(clusters, expected=None) -> int
+        Returns how many processes of the given 'clusters' have not
+        finished yet according to the events read so far.  If 'expected' is
+        given, it is the total number of processes submitted; otherwise only
+        processes whose submission is in the log are counted."""
+        clusters = set(clusters)
+        submitted = 0
+        finished = 0
+        for ((cluster, proc), event) in self.states.items():
+            if cluster in clusters:
+                submitted += 1
+                if event in self.FINISHED:
+                    finished += 1
+        if expected is None:
+            expected = submitted
+        return max(0, expected - finished)
+
+    def seen(self, clusters):
+        """seen(clusters) -> boolean
+        Returns whether any event of the given 'clusters' was read yet."""
+        clusters = set(clusters)
+        for (cluster, proc) in self.states:
+            if cluster in clusters:
+                return True
+        return False
+
+    def close(self):
+        """close()
+        Stops following a remote log, along with its 'tail' process."""
+        if self._tail is not None:
+            tail = self._tail
+            self._tail = None
+            tail._closeInput()
+            try:
+                tail.wait(1.0)
+            except subprocess.TimeoutExpired:
+                tail.kill()
+                tail.wait()
+
+class ProcTable(object):
+    """ProcTable()
+    A compact table of the status of every process of one or more clusters,
+    as reported by 'condor_q'.  Each column is a typed array, and the rows
+    are sorted by cluster and process id, so that a process can be looked up
+    quickly with find() and processes can be counted by status with count()
+    without going through them one by one in Python."""
+
+    IDLE = 1
+    RUNNING = 2
+    REMOVED = 3
+    COMPLETED = 4
+    HELD = 5
+    TRANSFERRING = 6
+    SUSPENDED = 7
+    statusNames = {IDLE: "idle", RUNNING: "running", REMOVED: "removed",
+                   COMPLETED: "completed", HELD: "held",
+                   TRANSFERRING: "transferring output",
+                   SUSPENDED: "suspended"}
+    # Job ClassAd attributes asked from 'condor_q', in column order
+    attributes = ("ClusterId", "ProcId", "JobStatus", "RemoteWallClockTime",
+                  "ImageSize")
+
+    def __init__(self):
+        self.clusters = array('l')
+        self.procIds = array('l')
+        self.statuses = array('b')
+        self.wallClockTimes = array('d')
+        self.imageSizes = array('q')
+        # cluster * 2**32 + procId of every row, for find()
+        self._keys = array('q')
+
+    def __len__(self):
+        return len(self.procIds)
+
+    @classmethod
+    def fromLines(cls, lines):
+        """fromLines(lines) -> ProcTable
+        Builds a table from the lines printed by 'condor_q -af' with the
+        attributes in 'attributes'.  Undefined values are read as 0."""
+        table = cls()
+        rows = []
+        for line in lines:
+            fields = line.split()
+            if len(fields) != len(cls.attributes) \
+                    or not fields[0].isdigit():
+                continue
+            values = [0 if f == "undefined" else f for f in fields]
+            rows.append((int(values[0]), int(values[1]), int(values[2]),
+                         float(values[3]), int(values[4])))
+        rows.sort()
+        for (cluster, procId, status, wallClock, imageSize) in rows:
+            table.clusters.append(cluster)
+            table.procIds.append(procId)
+            table.statuses.append(status)
+            table.wallClockTimes.append(wallClock)
+            table.imageSizes.append(imageSize)
+            table._keys.append((cluster << 32) + procId)
+        return table
+
+    def find(self, procId, cluster=None):
+        """find(procId, cluster=None) -> row_int
+        Returns the row index of process 'procId' of 'cluster' (by default,
+        the first cluster in the table), or None if it is not in the table."""
+        if cluster is None:
+            if not self.clusters:
+                return None
+            cluster = self.clusters[0]
+        key = (cluster << 32) + procId
+        i = bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            return i
+        return None
+
+    def row(self, procId, cluster=None):
+        """row(procId, cluster=None) -> dictionary
+        Returns the attributes of one process, or None if it is not in the
+        table.  See find()."""
+        i = self.find(procId, cluster)
+        if i is None:
+            return None
+        return {"ClusterId": self.clusters[i], "ProcId": self.procIds[i],
+                "JobStatus": self.statuses[i],
+                "RemoteWallClockTime": self.wallClockTimes[i],
+                "ImageSize": self.imageSizes[i]}
+
+    def count(self, status):
+        """count(status) -> int
+        Returns the number of processes with the given JobStatus, such as
+        ProcTable.IDLE."""
+        return self.statuses.count(status)
+
+    def counts(self):
+        """counts() -> dictionary
+        Returns the number of processes with each status, by status name."""
+        return dict([(self.statusNames[status], self.statuses.count(status))
+                     for status in self.statusNames])
+
+class ExecutableCache(object):
+    """ExecutableCache(maxSize=1024, ttl=None)
+    Remembers where executables were found on each submit shell so that
+    queueing many commands with the same executable only looks it up once.
+    At most 'maxSize' answers are kept, dropping the least recently used
+    ones first.  If 'ttl' is given, answers are forgotten after that many
+    seconds."""
+
+    def __init__(self, maxSize=1024, ttl=None):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        # (shell, executable, initialdir) -> (time found, resolved path)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, shell, executable, initialDirectory=None):
+        """get(shell, executable, initialDirectory=None) -> string
+        Returns the saved location of 'executable' on the Shell 'shell', or
+        None if it has not been found yet or the answer has expired."""
+        key = (str(shell), executable, initialDirectory)
+        with self._lock:
+            try:
+                (foundTime, path) = self._entries[key]
+            except KeyError:
+                return None
+            if self.ttl is not None and time() - foundTime >= self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return path
+
+    def put(self, shell, executable, initialDirectory, path):
+        """put(shell, executable, initialDirectory, path)
+        Saves 'path' as the location of 'executable' on the Shell 'shell'."""
+        key = (str(shell), executable, initialDirectory)
+        with self._lock:
+            self._entries[key] = (time(), path)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(False)
+
+    def invalidate(self, shell=None, executable=None):
+        """invalidate(shell=None, executable=None)
+        Forgets the saved locations of 'executable' on the Shell 'shell'.
+        Leaving out either argument forgets them for every executable or
+        every shell, respectively."""
+        with self._lock:
+            for key in list(self._entries):
+                if (shell is None or key[0] == str(shell)) \
+                        and (executable is None or key[1] == executable):
+                    del self._entries[key]
+
+# Locations of executables shared by every Job in this process
+executables = ExecutableCache()
+
+class StagingCache(object):
+    """StagingCache()
+    Copies local input files into a content-addressed cache directory on a
+    submit server, so that a file used by many submissions is only ever
+    uploaded once.  Each file is kept as "<directory>/<sha256>/<name>", so
+    a job still sees its original name.  Which files are already on each
+    server is remembered, and files are only hashed again once they
+    change."""
+
+    def __init__(self):
+        # absolute local path -> (mtime_ns, size, sha256)
+        self._hashes = {}
+        # (shell, directory) -> (absolute remote directory, set of blobs)
+        self._present = {}
+        self._lock = threading.Lock()
+
+    def _hash(self, path):
+        """_hash(path) -> string
+        Returns the SHA-256 hex digest of the local file 'path'."""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self._lock:
+            known = self._hashes.get(path)
+        if known is not None and known[:2] == (st.st_mtime_ns, st.st_size):
+            return known[2]
+        digest = hashlib.sha256()
+        f = open(path, 'rb')
+        try:
+            chunk = f.read(1 << 20)
+            while chunk:
+                digest.update(chunk)
+                chunk = f.read(1 << 20)
+        finally:
+            f.close()
+        with self._lock:
+            self._hashes[path] = (st.st_mtime_ns, st.st_size,
+                                  digest.hexdigest())
+        return digest.hexdigest()
+
+    @staticmethod
+    def _remoteDirectory(directory):
+        """_remoteDirectory(directory) -> string
+        Returns 'directory' quoted for the remote shell, relative to the home
+        directory unless it is absolute."""
+        if directory.startswith("/"):
+            return shlex.quote(directory)
+        return '"$HOME"/' + shlex.quote(directory)
+
+    def stage(self, shell, directory, paths):
+        """stage(shell, directory, paths) -> dictionary
+        Makes sure every local file in 'paths' is in the cache 'directory'
+        (relative to the home directory unless absolute) on the submit
+        server of the Shell 'shell', and returns a dictionary mapping each
+        of them to the absolute path of its cached copy.  Files not in the
+        cache yet are checked for with a single command and uploaded
+        together as one tar stream.  If the upload fails, a warning is
+        printed and the failed files are left out of the dictionary."""
+        blobs = OrderedDict()
+        for path in paths:
+            blobs[path] = self._hash(path) + "/" + os.path.basename(path)
+        key = (str(shell), directory)
+        with self._lock:
+            (remoteDirectory, present) = self._present.get(key, (None, set()))
+        missing = [path for path in blobs if blobs[path] not in present]
+        if missing or remoteDirectory is None:
+            # One round trip finds the cache and which blobs it already has
+            command = "mkdir -p " + self._remoteDirectory(directory) \
+                + " && cd " + self._remoteDirectory(directory) + " && pwd"
+            if missing:
+                command += " && { ls -1d -- " \
+                    + " ".join([shlex.quote(blobs[path]) for path in missing]) \
+                    + " 2>/dev/null; true; }"
+            retval, msg = shell.execute(command, idempotent=True,
+                                        family="staging check")
+            lines = msg.splitlines()
+            if retval != 0 or not lines:
+                print("Warning: Could not reach the staging directory",
+                      directory, file=sys.stderr)
+                return {}
+            remoteDirectory = lines[0]
+            present.update(lines[1:])
+            missing = [path for path in missing if blobs[path] not in present]
+        if missing:
+            uploaded = self._upload(shell, remoteDirectory,
+                                    [(path, blobs[path]) for path in missing])
+            if uploaded:
+                present.update([blobs[path] for path in missing])
+        with self._lock:
+            self._present[key] = (remoteDirectory, present)
+        return dict([(path, remoteDirectory + "/" + blobs[path])
+                     for path in blobs if blobs[path] in present])
+
+    def _upload(self, shell, remoteDirectory, files):
+        """_upload(shell, remoteDirectory, files) -> boolean
+        Sends the (local path, blob) pairs 'files' into 'remoteDirectory' as
+        a single tar stream.  The files are unpacked into a temporary
+        directory first and then moved into place, so a failed upload never
+        leaves half a file in the cache.  Returns whether it worked."""
+        p = shell.spawn("cd " + shlex.quote(remoteDirectory) \
+            + ' && t=$(mktemp -d .upload.XXXXXX) || exit 1; s=0;' \
+            + ' if tar xf - -C "$t"; then for f in "$t"/*/*; do' \
+            + ' d=${f%/*}; h=${d##*/}; mkdir -p "$h" && mv -f "$f" "$h"/' \
+            + ' || s=1; done; else s=1; fi; rm -rf "$t"; exit $s',
+            family="staging upload")
+        writer = io.BufferedWriter(_InputWriter(p), 65536)
+        try:
+            archive = tarfile.open(fileobj=writer, mode="w|", dereference=True)
+            for (path, blob) in files:
+                archive.add(path, blob)
+            archive.close()
+            writer.flush()
+        except TalkingToDeadError:
+            pass
+        msg = p.get(True)
+        if p.poll() != 0:
+            print("Warning: Could not upload input files to the staging " \
+                  + "directory:", msg, file=sys.stderr)
+            return False
+        return True
+
+    def invalidate(self, shell=None):
+        """invalidate(shell=None)
+        Forgets which files are in the caches of the Shell 'shell' (or of
+        every shell), so they are checked for again."""
+        with self._lock:
+            for key in list(self._present):
+                if shell is None or key[0] == str(shell):
+                    del self._present[key]
+
+# Staged input files shared by every Job in this process
+staging = StagingCache()
+
+class ResultIndex(object):
+    """ResultIndex(filename=None)
+    A local SQLite index of the entries Jobs have already run, keyed by a
+    fingerprint of each entry's executable, arguments, settings and input
+    files (see Job.setResultIndex()), along with where each entry's output
+    went.  By default, the index is kept in the user's home directory."""
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(os.path.expanduser("~"),
+                                    ".condor_results.sqlite")
+        self.filename = filename
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """_connect() -> sqlite3.Connection
+        Opens the index once, creating its table if necessary."""
+        if self._db is None:
+            self._db = sqlite3.connect(self.filename, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS results " \
+                             + "(fingerprint TEXT PRIMARY KEY, " \
+                             + "finished REAL, outputs TEXT)")
+        return self._db
+
+    def get(self, fingerprint):
+        """get(fingerprint) -> [string, ...]
+        Returns the output files recorded for the entry 'fingerprint', or
+        None if it has not finished yet."""
+        with self._lock:
+            row = self._connect().execute("SELECT outputs FROM results " \
+                                          + "WHERE fingerprint = ?",
+                                          (fingerprint,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def record(self, entries):
+        """record(entries)
+        Records the (fingerprint, [output file, ...]) pairs 'entries' as
+        finished."""
+        now = time()
+        with self._lock:
+            db = self._connect()
+            db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                           [(fingerprint, now, json.dumps(outputs))
+                            for (fingerprint, outputs) in entries])
+            db.commit()
+
+    def forget(self, fingerprint=None):
+        """forget(fingerprint=None)
+        Forgets the entry 'fingerprint', or every entry, so it runs again."""
+        with self._lock:
+            db = self._connect()
+            if fingerprint is None:
+                db.execute("DELETE FROM results")
+            else:
+                db.execute("DELETE FROM results WHERE fingerprint = ?",
+                           (fingerprint,))
+            db.commit()
+
+    def close(self):
+        """close()
+        Closes the index.  It is opened again when next needed."""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+class SubmitDescription(object):
+    """SubmitDescription()
+    Builds the text of a Condor submit description one Queue statement at a
+    time.  Every Queue statement only writes out the settings that changed
+    since the previous one, since Condor keeps using the earlier values of
+    the others.  The statements are kept in a list and only joined into text
+    when the text is asked for, so building a description with many Queue
+    statements takes time proportional to its length."""
+
+    def __init__(self):
+        # Settings written out so far, as the strings that were written
+        self._inEffect = {}
+        # (changes, times, items) for every statement; see addQueue()
+        self._blocks = []
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def _changes(self, settings, inEffect):
+        """_changes(settings, inEffect) -> [(key, valueStr), ...]
+        Returns the settings in the dictionary 'settings' that differ from
+        those in 'inEffect'.  Settings that were removed have the value
+        None."""
+        changes = []
+        for key in settings:
+            value = str(settings[key])
+            if inEffect.get(key) != value:
+                changes.append((key, value))
+        for key in inEffect:
+            if not key in settings:
+                changes.append((key, None))
+        return changes
+
+    def _apply(self, changes, inEffect):
+        """_apply(changes, inEffect)
+        Updates the dictionary 'inEffect' with the list 'changes'."""
+        for (key, value) in changes:
+            if value is None:
+                del inEffect[key]
+            else:
+                inEffect[key] = value
+
+    def fork(self):
+        """fork() -> SubmitDescription
+        Returns a new, empty description that continues from the settings
+        written by this one, so that its text can be appended to this one's
+        without repeating unchanged settings."""
+        retval = SubmitDescription()
+        retval._inEffect = dict(self._inEffect)
+        return retval
+
+    def queueText(self, settings, times=1, items=None):
+        """queueText(settings, times=1, items=None) -> string
+        Like addQueue(), but returns the text of the statement instead of
+        keeping it in the description.  Later statements still only write
+        the settings that changed since this one."""
+        changes = self._changes(settings, self._inEffect)
+        self._apply(changes, self._inEffect)
+        return self._blockText(changes, times, items)
+
+    def addQueue(self, settings, times=1, items=None):
+        """addQueue(settings, times=1, items=None)
+        Adds a Queue statement using the dictionary 'settings' to the
+        description.  The statement queues 'times' processes, or, if 'items'
+        is a list of argument strings, 'times' processes for each of them
+        using the "Queue arguments from (...)" form.  If 'times' is None, only
+        the changed settings are written, without a Queue statement."""
+        changes = self._changes(settings, self._inEffect)
+        self._apply(changes, self._inEffect)
+        self._blocks.append((changes, times, items))
+
+    def _blockText(self, changes, times, items):
+        """_blockText(changes, times, items) -> string
+        Returns the text of one statement added by addQueue()."""
+        lines = []
+        for (key, value) in changes:
+            if value is None:
+                # An empty value removes the setting
+                lines.append(str(key) + " =\n")
+            else:
+                lines.append(str(key) + " = " + value + "\n")
+        if times is not None:
+            if times != 1:
+                queueLine = "Queue " + str(times)
+            else:
+                queueLine = "Queue"
+            if items is None:
+                lines.append(queueLine + "\n")
+            else:
+                lines.append(queueLine + " arguments from (\n")
+                for argStr in items:
+                    lines.append('"' + argStr + '"\n')
+                lines.append(")\n")
+        return "".join(lines)
+
+    def procCount(self):
+        """procCount() -> int
+        Returns the number of processes the description queues."""
+        count = 0
+        for (changes, times, items) in self._blocks:
+            if times is not None:
+                count += times * (len(items) if items is not None else 1)
+        return count
+
+    @staticmethod
+    def expandMacros(value, cluster, procId):
+        """expandMacros(value, cluster, procId) -> string
+        Replaces the Condor macros for the cluster and process ids in the
+        setting 'value'."""
+        for macro in ("$(Cluster)", "$(ClusterId)"):
+            value = value.replace(macro, str(cluster))
+        for macro in ("$(Process)", "$(ProcId)"):
+            value = value.replace(macro, str(procId))
+        return value
+
+    def iterStatements(self):
+        """iterStatements() -> iterator of dictionaries
+        Yields the settings in effect at every statement, in order.  The
+        dictionary is reused between statements, so copy it to keep it."""
+        inEffect = {}
+        for (changes, times, items) in self._blocks:
+            self._apply(changes, inEffect)
+            yield inEffect
+
+    def mapped(self, function):
+        """mapped(function) -> SubmitDescription
+        Returns a copy of the description in which the settings in effect at
+        every statement are replaced by the dictionary returned by
+        function(settings).  'function' must not change 'settings'."""
+        retval = SubmitDescription()
+        for ((changes, times, items), inEffect) in zip(self._blocks,
+                                                       self.iterStatements()):
+            retval.addQueue(function(inEffect), times, items)
+        return retval
+
+    def iterProcs(self):
+        """iterProcs() -> iterator of (dictionary, string)
+        Yields the settings in effect and the "Arguments" value of every
+        queued process, in order.  The dictionary is reused between
+        processes, so copy it to keep it."""
+        inEffect = {}
+        for (changes, times, items) in self._blocks:
+            self._apply(changes, inEffect)
+            if times is None:
+                continue
+            if items is None:
+                for i in range(times):
+                    yield (inEffect, inEffect.get("Arguments"))
+            else:
+                for argStr in items:
+                    for i in range(times):
+                        yield (inEffect, '"' + argStr + '"')
+
+    def iterShards(self, size):
+        """iterShards(size) -> iterator of (string, int)
+        Splits the description into complete descriptions of at most 'size'
+        processes each (unless a single item is queued more than 'size'
+        times) and yields the text and number of processes of each.  Each
+        one starts by writing every setting in effect at that point, so they
+        can be submitted separately."""
+        inEffect = {}
+        parts = []
+        count = 0
+        for (changes, times, items) in self._blocks:
+            self._apply(changes, inEffect)
+            if times is None:
+                if parts:
+                    parts.append(self._blockText(changes, None, None))
+                continue
+            if items is None:
+                # Units of one process each, "Queue n" being n units
+                (unitSize, remaining) = (1, times)
+            else:
+                (unitSize, remaining) = (times, list(items))
+            first = True
+            while remaining:
+                room = size - count
+                if parts and room < unitSize:
+                    yield ("".join(parts), count)
+                    (parts, count, room) = ([], 0, size)
+                if not parts:
+                    pieceChanges = list(inEffect.items())
+                elif first:
+                    pieceChanges = changes
+                else:
+                    pieceChanges = []
+                take = max(1, room // unitSize)
+                if items is None:
+                    take = min(take, remaining)
+                    parts.append(self._blockText(pieceChanges, take, None))
+                    remaining -= take
+                    count += take
+                else:
+                    parts.append(self._blockText(pieceChanges, times,
+                                                 remaining[:take]))
+                    count += times * len(remaining[:take])
+                    remaining = remaining[take:]
+                first = False
+                if count >= size:
+                    yield ("".join(parts), count)
+                    (parts, count) = ([], 0)
+        if parts:
+            yield ("".join(parts), count)
+
+    def iterText(self, settings=None):
+        """iterText(settings=None) -> iterator of strings
+        Yields the text of the description one statement at a time.  If the
+        dictionary 'settings' is given, the settings in it that have not been
+        written yet are yielded last, without changing the description."""
+        for (changes, times, items) in self._blocks:
+            yield self._blockText(changes, times, items)
+        if settings is not None:
+            yield self._blockText(self._changes(settings, self._inEffect),
+                                  None, None)
+
+    def getvalue(self, settings=None):
+        """getvalue(settings=None) -> string
+        Returns the whole text of the description.  See iterText() for
+        'settings'."""
+        return "".join(self.iterText(settings))
+
+    def writeTo(self, fileObject, settings=None):
+        """writeTo(fileObject, settings=None)
+        Writes the text of the description to the file 'fileObject' one
+        statement at a time.  See iterText() for 'settings'."""
+        for text in self.iterText(settings):
+            fileObject.write(text)
+
+class MailMap(object):
+    """MailMap(shell, remotePath='/mnt/config/scripts/mail_map.pickle', cacheFile=None)
+    Looks up users' email addresses in the mail mapping file 'remotePath'
+    (a pickled dictionary, see editMailMap.py) on the machine of the Shell
+    'shell'.  The mapping is copied into a small local SQLite database,
+    'cacheFile', indexed by username, so a lookup does not load the whole
+    mapping.  The remote file is only copied again once its modification
+    time or size changes.  By default, the database is kept in the user's
+    home directory."""
+
+    def __init__(self, shell, remotePath="/mnt/config/scripts/mail_map.pickle",
+                 cacheFile=None):
+        self.shell = shell
+        self.remotePath = remotePath
+        if cacheFile is None:
+            name = re.sub("[^A-Za-z0-9_.@-]", "_",
+                          str(shell)[len("<Shell: "):-1] + remotePath)
+            cacheFile = os.path.join(os.path.expanduser("~"),
+                                     ".condor_mail_map_" + name + ".sqlite")
+        self.cacheFile = cacheFile
+
+    def _connect(self, filename):
+        """_connect(filename) -> sqlite3.Connection
+        Opens the database 'filename', creating its tables if necessary."""
+        db = sqlite3.connect(filename)
+        db.execute("CREATE TABLE IF NOT EXISTS emails " \
+                   + "(username TEXT PRIMARY KEY, email TEXT)")
+        db.execute("CREATE TABLE IF NOT EXISTS source (stamp TEXT)")
+        return db
+
+    def _cachedStamp(self):
+        """_cachedStamp() -> string
+        Returns the modification time and size of the remote file when it was
+        last copied, or None if it has not been copied yet."""
+        if not os.path.exists(self.cacheFile):
+            return None
+        db = self._connect(self.cacheFile)
+        try:
+            row = db.execute("SELECT stamp FROM source").fetchone()
+        finally:
+            db.close()
+        if row is None:
+            return None
+        return row[0]
+
+    def refresh(self):
+        """refresh() -> boolean
+        Copies the remote mapping into the local database if it changed
+        since the last copy.  Returns False if the remote file could not be
+        read, in which case the last copy (if any) is kept."""
+        (status, stamp) = self.shell.execute("stat -c '%Y %s' " \
+                                             + shlex.quote(self.remotePath),
+                                             idempotent=True)
+        if status != 0:
+            return False
+        if stamp == self._cachedStamp():
+            return True
+        (status, bytesOut) = self.shell.execute( \
+                "cat " + shlex.quote(self.remotePath), returnBytes=True,
+                idempotent=True)
+        if status != 0:
+            return False
+        emails = pickle.load(BytesIO(bytesOut))
+        # Build the new copy next to the old one and swap it in at once, so
+        # that lookups never see a half written database
+        tempName = self.cacheFile + "." + str(os.getpid()) + ".tmp"
+        db = self._connect(tempName)
+        try:
+            db.execute("DELETE FROM emails")
+            db.executemany("INSERT INTO emails VALUES (?, ?)",
+                           [(username, email)
+                            for (username, email) in emails.items()])
+            db.execute("DELETE FROM source")
+            db.execute("INSERT INTO source VALUES (?)", (stamp,))
+            db.commit()
+        finally:
+            db.close()
+        os.replace(tempName, self.cacheFile)
+        return True
+
+    def lookup(self, username):
+        """lookup(username) -> string
+        Returns the email address of 'username' (None looks up the default
+        address), refreshing the local copy first if necessary.  Raises
+        KeyError if 'username' is not in the mapping and IOError if the
+        mapping has never been readable."""
+        if not self.refresh() and self._cachedStamp() is None:
+            raise IOError("Could not read the mail mapping " + self.remotePath)
+        db = self._connect(self.cacheFile)
+        try:
+            row = db.execute("SELECT email FROM emails WHERE username IS ?",
+                             (username,)).fetchone()
+        finally:
+            db.close()
+        if row is None:
+            raise KeyError(username)
+        return row[0]
+
+class Backend(object):
+    """Backend() - Should not normally be directly called.
+    Base class for the ways a Job can run its queued processes other than
+    submitting them to Condor.  See Job.setBackend()."""
+
+    # Whether commands (such as finding executables) run on this machine
+    local = False
+
+    def submit(self, job):
+        """submit(job) -> cluster_int
+        Starts running every process queued in 'job' and returns an id for
+        them."""
+        raise NotImplementedError
+
+    def poll(self, job):
+        """poll(job) -> runningProcesses_int"""
+        raise NotImplementedError
+
+    def wait(self, job):
+        """wait(job)"""
+        raise NotImplementedError
+
+    def status(self, job):
+        """status(job) -> string"""
+        return str(self.poll(job)) + " processes of cluster " \
+               + str(job.cluster) + " are still running."
+
+    def returnValues(self, job):
+        """returnValues(job) -> [int, ...]
+        Returns the return value of every process of 'job' in order, or None
+        for processes that have not finished yet.  Backends that cannot tell
+        return an empty list."""
+        return []
+
+class LocalBackend(Backend):
+    """LocalBackend(cpus=None)
+    Runs the processes queued in a Job on this machine instead of
+    submitting them to Condor, which is much faster for small, short jobs.
+    At most 'cpus' CPUs (by default, all of them) are used at once, and each
+    process gets as many as its "request_cpus" setting asks for.  The
+    "Executable", "Arguments", "Input", "Output", "Error" and "initialdir"
+    settings are honored, including the $(Cluster) and $(Process) macros;
+    other settings are ignored."""
+
+    local = True
+    # Cluster ids given to local runs, so that they look like Condor's
+    _nextCluster = 1
+    _clusterLock = threading.Lock()
+
+    def __init__(self, cpus=None):
+        if cpus is None:
+            cpus = os.cpu_count() or 1
+        self.cpus = cpus
+        self._freeCpus = cpus
+        self._cpuCondition = threading.Condition()
+        self._pool = ThreadPoolExecutor(cpus)
+        # cluster -> [Future of the return value of every process]
+        self._runs = {}
+
+    @staticmethod
+    def _splitArguments(argStr):
+        """_splitArguments(argStr) -> [string, ...]
+        Splits an "Arguments" value written by Job.setArguments() into the
+        separate arguments."""
+        if argStr is None:
+            return []
+        argStr = argStr.strip()
+        if len(argStr) >= 2 and argStr[0] == '"' and argStr[-1] == '"':
+            argStr = argStr[1:-1].replace('""', '"')
+        return shlex.split(argStr)
+
+    def _runProc(self, argv, cwd, cpus, inputPath, outputPath, errorPath):
+        """_runProc(argv, cwd, cpus, inputPath, outputPath, errorPath) -> int
+        Runs one process once 'cpus' CPUs are free and returns its return
+        value."""
+        cpus = max(1, min(cpus, self.cpus))
+        with self._cpuCondition:
+            while self._freeCpus < cpus:
+                self._cpuCondition.wait()
+            self._freeCpus -= cpus
+        files = []
+        try:
+            def redirect(path, mode):
+                if path is None:
+                    return subprocess.DEVNULL
+                f = open(os.path.join(cwd, path), mode)
+                files.append(f)
+                return f
+            return subprocess.call(argv, cwd=cwd,
+                                   stdin=redirect(inputPath, 'rb'),
+                                   stdout=redirect(outputPath, 'wb'),
+                                   stderr=redirect(errorPath, 'wb'))
+        finally:
+            for f in files:
+                f.close()
+            with self._cpuCondition:
+                self._freeCpus += cpus
+                self._cpuCondition.notify_all()
+
+    def submit(self, job):
+        with LocalBackend._clusterLock:
+            cluster = LocalBackend._nextCluster
+            LocalBackend._nextCluster += 1
+        submitDirectory = os.getcwd()
+        runs = []
+        procId = 0
+        for (settings, argStr) in job._description.iterProcs():
+            def setting(key):
+                if not key in settings:
+                    return None
+                return SubmitDescription.expandMacros(settings[key], cluster, procId)
+            cwd = os.path.join(submitDirectory, setting("initialdir") or "")
+            executable = setting("Executable")
+            if not "/" in executable:
+                executable = os.path.join(cwd, executable)
+            argv = [executable] + self._splitArguments( \
+                    SubmitDescription.expandMacros(argStr, cluster, procId) \
+                    if argStr is not None else None)
+            runs.append(self._pool.submit(self._runProc, argv, cwd,
+                                          int(settings.get("request_cpus", 1)),
+                                          setting("Input"), setting("Output"),
+                                          setting("Error")))
+            procId += 1
+        self._runs[cluster] = runs
+        print(str(procId) + " job(s) started locally as cluster " \
+              + str(cluster) + ".")
+        return cluster
+
+    def _clusterRuns(self, job):
+        """_clusterRuns(job) -> [Future, ...]"""
+        runs = []
+        for cluster in job._activeClusters():
+            runs.extend(self._runs.get(cluster, []))
+        return runs
+
+    def poll(self, job):
+        return len([run for run in self._clusterRuns(job) if not run.done()])
+
+    def wait(self, job):
+        waitForFutures(self._clusterRuns(job))
+
+    def returnValues(self, job):
+        """returnValues(job) -> [int, ...]
+        Returns the return value of every process of 'job' in order, or None
+        for processes that have not finished yet or could not be started."""
+        return [run.result() if run.done() and run.exception() is None
+                else None for run in self._clusterRuns(job)]
+
+class _SharedSettings(MutableMapping):
+    """_SharedSettings(values)
+    The settings of a Job made by Job.clone(), which share the dictionary
+    'values' with the Job they were cloned from (and its other clones) until
+    they are first changed, when they get their own copy.  Setting a value
+    to what it already is does not count as a change."""
+
+    __slots__ = ("_values", "_shared", "_without")
+
+    def __init__(self, values):
+        self._values = values
+        self._shared = True
+        # (key, values without it) made by shareWithout(), until a change
+        self._without = None
+
+    def share(self):
+        """share() -> _SharedSettings
+        Returns new settings sharing these settings' values, which these
+        settings then stop changing in place."""
+        self._shared = True
+        return _SharedSettings(self._values)
+
+    def shareWithout(self, key):
+        """shareWithout(key) -> _SharedSettings
+        Like share(), but the new settings lack 'key'.  The values without
+        'key' are copied once and then shared by every settings returned,
+        until these settings change."""
+        if not key in self._values:
+            return self.share()
+        if self._without is None or self._without[0] != key:
+            values = dict(self._values)
+            del values[key]
+            self._without = (key, values)
+        return _SharedSettings(self._without[1])
+
+    def _own(self):
+        """_own()
+        Copies the shared values before the first change."""
+        if self._shared:
+            self._values = dict(self._values)
+            self._shared = False
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        if self._shared and key in self._values \
+                and self._values[key] == value:
+            return
+        self._own()
+        self._without = None
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        self._own()
+        self._without = None
+        del self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+def _parseClusterOutput(retval, msg, program, warning):
+    """_parseClusterOutput(retval, msg, program, warning) -> cluster_int
+    Returns the cluster id in the output 'msg' of the submit command
+    'program' ('condor_submit' or 'condor_submit_dag'), or None if its
+    return value 'retval' says it failed, in which case the error and
+    'warning' are printed."""
+    if retval != 0:
+        print("ERROR #" + str(retval) + ":", str(msg), file=sys.stderr)
+        print("WARNING: Since '" + program + "' returned an error, " \
+              + warning, file=sys.stderr)
+        return None
+    print(msg)
+    clusterRE = re.search(r"(cluster )(\d+)", msg)
+    if clusterRE is None: raise BadFormatError(program)
+    return int(clusterRE.group(2))
+
 class Job(object):
-    """Job(universe='vanilla', username=None, server='condor.cs.wlu.edu')
+    """Job(universe='vanilla', username=None, server='condor.cs.wlu.edu', backend=None)
     Instantiates a Condor object that acts as an interface to the given Condor
     server.  This object can be used to submit jobs using a familiar Python
-    environment."""
+    environment.  If a Backend such as LocalBackend() is given as 'backend',
+    submit(), poll(), wait() and status() run the job with it instead of
+    Condor."""
+
+    # Settings needed to find the files a process writes
+    _outputKeys = ("Output", "Error", "Log", "initialdir")
 
     def __init__(self, universe="vanilla",
-                 username=None, server="condor.cs.wlu.edu"):
+                 username=None, server="condor.cs.wlu.edu", backend=None):
         self._validUniverses = ["vanilla", "standard", "java",
                                 "scheduler", "local", "grid", "vm"]
         self._settings = {}
-        self.submitLinesSoFar = ""
-        self._submitShell = None
+        self._description = SubmitDescription()
+        self._shell = None
+        self._asyncSubmitShell = None
         self._executablePath = ""
+        self._emailPending = False
+        self._backend = backend
         self.cluster = None
+        # Every cluster this job was submitted as, None for failed shards
+        self.clusters = []
+        self.failedShards = {}
+        # Whether wait() and poll() follow the user log instead of condor_q
+        self.followLog = True
+        self._userLog = None
+        self._expectedProcs = None
+        self._shardProcs = []
+        # [settings, processes] of the entries sent by submitStream()
+        self._streamedProcs = []
         self.maxPollTime = 30.0
-        try:
-            self._submitterUsername = Process('whoami').get().strip()
-        except:
-            self._submitterUsername = None
+        # ResultIndex of entries that already ran, if memoizing
+        self._results = None
+        # [fingerprint or None, processes] of every queued entry, in order
+        self._fingerprints = []
+        # The output files of every entry skipped because it already ran
+        self.reused = []
+        # Cache directory for input files on the submit server, if staging
+        self._stagingDirectory = None
         self.setUniverse(universe)
         self._setUsername(username)
         self._setServer(server)
         self.setCPUNum(1)
         self.setRAM(1024)
         self.setDiskSpace(32)
-
-        p = Process("which condor_submit")
-        if p.wait() == 0 and self.getUsername() == self._submitterUsername:
-            # condor_submit exists, so run it locally
-            # UNLESS the usernames don't match
-            self._submitShell = Shell()
-        else:
-            # condor_submit doesn't exist, so run it over SSH
-            self._submitShell = Shell(self.getServer(), self.getUsername())
-            # Set the default directory to the current directory
-            # of the local user
-
+        # The email address is only looked up once it is needed
         self.setEmail(None)
 
+    @property
+    def _submitShell(self):
+        """The Shell used to run Condor commands, which is only set up once
+        it is first needed."""
+        if self._shell is None and self._backend is not None \
+                and self._backend.local:
+            # The backend runs everything here
+            self._shell = Shell()
+        if self._shell is None:
+            local = _localEnvironment()
+            if local["condorSubmit"] \
+                    and self.getUsername() == local["username"]:
+                # condor_submit exists, so run it locally
+                # UNLESS the usernames don't match
+                self._shell = Shell()
+            else:
+                # condor_submit doesn't exist, so run it over SSH
+                self._shell = Shell(self.getServer(), self.getUsername())
+        return self._shell
+
     def __str__(self):
         return "<Job: " \
                + str(self.getUsername()) + "@" + str(self.getServer()) + "\n" \
-               + self._generateSubmitString(False).strip() \
+               + self._generateSubmitString(False, False).strip() \
                + ">"
 
+    def clone(self):
+        """clone() -> Job
+        Returns a new Job with the same settings, username, server, submit
+        shell, backend, staging directory and ResultIndex as this one, but
+        with nothing queued and not submitted.  The arguments of the last
+        command queued in this Job are not carried over, and the clone may
+        queue a different executable without a warning.  No environment
+        probes run and no defaults are set again, and the settings are
+        shared with this Job until either of them changes a setting, so
+        making many slightly different Jobs from one template is cheap in
+        both time and memory."""
+        # Resolve the shell once for every clone
+        self._submitShell
+        self._resolveEmail()
+        child = Job.__new__(Job)
+        child.__dict__.update(self.__dict__)
+        if not isinstance(self._settings, _SharedSettings):
+            self._settings = _SharedSettings(self._settings)
+        child._settings = self._settings.shareWithout("Arguments")
+        child._executablePath = ""
+        child._description = SubmitDescription()
+        child.cluster = None
+        child.clusters = []
+        child.failedShards = {}
+        child._userLog = None
+        child._expectedProcs = None
+        child._shardProcs = []
+        child._streamedProcs = []
+        child._fingerprints = []
+        child.reused = []
+        return child
+
+    def getBackend(self):
+        """getBackend() -> Backend
+        Returns the Backend that runs this job, or None if it is submitted
+        to Condor."""
+        return self._backend
+
+    def setBackend(self, backend):
+        """setBackend(backend)
+        Makes submit(), poll(), wait() and status() run this job with the
+        Backend 'backend' (such as LocalBackend()) instead of Condor, or with
+        Condor again if 'backend' is None.  This should be done before
+        queueing anything, since executables are looked up wherever the
+        backend runs."""
+        self._backend = backend
+        self._shell = None
+        self._asyncSubmitShell = None
+
     def getUniverse(self):
         """getUniverse() -> string
         Returns the currently chosen Condor universe that this object
@@ -395,6 +2591,8 @@ class Job(object):
         Returns the username that this object will use to submit the job
         to Condor via the designated Condor submit server.  Note that this
         object will access the submit server with this username through SSH."""
+        if self.username is None:
+            return _localEnvironment()["username"]
         return self.username
 
     def _setUsername(self, string):
@@ -402,12 +2600,9 @@ class Job(object):
         Sets the username that this object will use to submit the job to
         Condor via the designated Condor submit server.  Note that this
         object will access the submit server with this username through SSH.
-        If 'string' is 'None', the username will be set to the output of the
-        'whoami' command."""
-        if string is None:
-            self.username = self._submitterUsername
-        else:
-            self.username = string
+        If 'string' is 'None', the username will be the output of the
+        'whoami' command, which is looked up once it is first needed."""
+        self.username = string
 
     def getServer(self):
         """getServer() -> string
@@ -438,7 +2633,13 @@ class Job(object):
         required.  If it is a user-created program in the current directory,
         leave the value alone.  Don't use more than one executable per
         submission."""
-        newPath = self._resolveExecutable(string)
+        self._useExecutable(self._resolveExecutable(string), True)
+
+    def _useExecutable(self, newPath, warn):
+        """_useExecutable(newPath, warn)
+        Sets the "Executable" setting to the already resolved 'newPath'.  If
+        'warn' is True, a warning is printed if it differs from the
+        executable used so far."""
         if "/" in newPath.replace("\\/", ""):
             self.setTransferExecutable(False)
         if not self._executablePath:
@@ -448,11 +2649,12 @@ class Job(object):
         else:
             # Executable was already set before
             # Warn if the user tries to make it something different
-            if "Executable" in self._settings \
-                    and self.getExecutable() != newPath:
-                print("Warning: Generally speaking, only one executable should " \
-                      "be used per submission.", file=sys.stderr)
+            if self._executablePath != newPath:
+                if warn:
+                    print("Warning: Generally speaking, only one executable " \
+                          "should be used per submission.", file=sys.stderr)
                 self._settings["Executable"] = newPath
+                self._executablePath = newPath
 
     def getTransferExecutable(self):
         """getTransferExecutable() -> string"""
@@ -476,23 +2678,36 @@ class Job(object):
         application that is not in the current directory.  If it is an
         executable that is in the current directory, it returns the
         given string.  This is a function that does not modify the
-        state of the object."""
-        if self._submitShell.execute("ls " + str(string))[0] != 0:
+        state of the object.  Answers are remembered in the module's
+        ExecutableCache, 'executables', so each executable is only looked up
+        once per submit shell and initial directory."""
+        initialDirectory = self._settings.get("initialdir")
+        path = executables.get(self._submitShell, string, initialDirectory)
+        if path is not None:
+            return path
+        # Ask for both answers at once to save a round trip to the submit shell
+        ((lsStatus, lsReply), (status, reply)) = \
+                self._submitShell.executeMany(["ls " + str(string),
+                                               "which " + str(string)],
+                                              idempotent=True)
+        if lsStatus != 0:
             # The executable is not fully qualified or is not in the
             # current working directory
-            (status, reply) = self._submitShell.execute("which " + str(string))
             if status == 0:
                 # The executable was a standard application, so return
                 # the full path to its executable
-                return reply.strip()
+                path = reply.strip()
             else:
+                # Not remembered, so it is looked for again next time
                 print("Warning: Could not find Executable:",
-                      self.getExecutable(), file=sys.stderr)
+                      string, file=sys.stderr)
                 return string
         else:
             # The executable is either fully qualified or it is in the current
             # working directory
-            return string
+            path = string
+        executables.put(self._submitShell, string, initialDirectory, path)
+        return path
 
     def getArguments(self):
         """getArguments() -> string
@@ -633,6 +2848,289 @@ class Job(object):
         """setTransferFiles(string)"""
         self._settings["should_transfer_files"] = string
 
+    def getTransferInputFiles(self):
+        """getTransferInputFiles() -> string"""
+        try:
+            return self._settings["transfer_input_files"]
+        except KeyError:
+            raise EmptySetting("transfer_input_files")
+
+    def setTransferInputFiles(self, string):
+        """setTransferInputFiles(string)
+        Sets the comma-separated list of files that Condor copies to the
+        machine running the job."""
+        self._settings["transfer_input_files"] = string
+
+    def getStaging(self):
+        """getStaging() -> string
+        Returns the staging directory set with setStaging(), or None."""
+        return self._stagingDirectory
+
+    def setStaging(self, directory=".condor_staging"):
+        """setStaging(directory=".condor_staging")
+        From now on, local files named by the "Input", "transfer_input_files"
+        and (if it is transferred) "Executable" settings are copied into the
+        content-addressed cache 'directory' on the submit server (relative
+        to the home directory unless absolute), and the submit description
+        refers to the cached copies instead.  Each distinct file is uploaded
+        at most once, however many jobs and submissions use it (see
+        StagingCache).  Like Condor, relative names are taken to be relative
+        to the "initialdir" setting, if any, which is looked up locally
+        relative to the current directory; settings naming files that don't
+        exist locally are left alone.  Files are staged when the job is
+        submitted or saved, all with one check of the cache per submission.
+        If 'directory' is None, staging is turned off."""
+        self._stagingDirectory = directory
+
+    @staticmethod
+    def _stagingNames(settings):
+        """_stagingNames(settings) -> dictionary
+        Returns the files named by the settings in the dictionary 'settings'
+        that staging may replace, as a dictionary mapping each setting to a
+        list of (name, local path) pairs.  The local path is None if the
+        name does not refer to a local file."""
+        names = {}
+        if "Input" in settings:
+            names["Input"] = [settings["Input"]]
+        if "transfer_input_files" in settings:
+            names["transfer_input_files"] = [name.strip() for name in \
+                settings["transfer_input_files"].split(",")]
+        if str(settings.get("transfer_executable", True)).lower() != "false" \
+                and "Executable" in settings:
+            names["Executable"] = [settings["Executable"]]
+        initialdir = settings.get("initialdir")
+        def localPath(name):
+            path = str(name)
+            if initialdir and not os.path.isabs(path):
+                path = os.path.join(str(initialdir), path)
+            if os.path.isfile(path):
+                return path
+            return None
+        return dict([(key, [(name, localPath(name)) for name in names[key]])
+                     for key in names])
+
+    def _stage(self, settingsList):
+        """_stage(settingsList) -> dictionary
+        Stages the local files named by every dictionary of settings in the
+        iterable 'settingsList' with a single call to StagingCache.stage()
+        and returns its result."""
+        paths = OrderedDict()
+        for settings in settingsList:
+            names = self._stagingNames(settings)
+            for key in names:
+                for (name, path) in names[key]:
+                    if path is not None:
+                        paths[path] = True
+        if not paths:
+            return {}
+        return staging.stage(self._submitShell, self._stagingDirectory,
+                             list(paths))
+
+    def _stagedSettings(self, settings, staged=None):
+        """_stagedSettings(settings, staged=None) -> dictionary
+        Returns the dictionary 'settings' as it is submitted: unchanged, or a
+        copy pointing at staged input files if staging is on.  'staged' is
+        the result of _stage() for these settings, which is called if it is
+        None."""
+        if self._stagingDirectory is None:
+            return settings
+        if staged is None:
+            staged = self._stage([settings])
+        names = self._stagingNames(settings)
+        if not [path for key in names for (name, path) in names[key]
+                if path in staged]:
+            return settings
+        settings = dict(settings)
+        for key in names:
+            settings[key] = ", ".join([staged.get(path, name)
+                                       for (name, path) in names[key]])
+        if "Executable" in names and names["Executable"][0][1] in staged:
+            settings["transfer_executable"] = True
+        return settings
+
+    def _stagedDescription(self, settings=None):
+        """_stagedDescription(settings=None) -> (SubmitDescription, dictionary)
+        Returns the submit description as it is submitted: this job's own,
+        or a copy pointing at staged input files if staging is on.  If the
+        dictionary of settings 'settings' is given, it is staged as well and
+        returned along with the description (otherwise None is).  Files are
+        only staged when a job is submitted or saved, never when it is just
+        printed, and the files of every statement are staged together."""
+        if self._stagingDirectory is None:
+            return (self._description, settings)
+        settingsList = self._description.iterStatements()
+        if settings is not None:
+            settingsList = chain(settingsList, [settings])
+        staged = self._stage(settingsList)
+        description = self._description.mapped( \
+            lambda inEffect: self._stagedSettings(inEffect, staged))
+        if settings is not None:
+            settings = self._stagedSettings(settings, staged)
+        return (description, settings)
+
+    def getResultIndex(self):
+        """getResultIndex() -> ResultIndex
+        Returns the ResultIndex set with setResultIndex(), or None."""
+        return self._results
+
+    def setResultIndex(self, index):
+        """setResultIndex(index)
+        From now on, queue() and queueMany() skip every entry that the
+        ResultIndex 'index' says already ran with the same executable,
+        arguments, settings (other than the email ones) and contents of the
+        local input files, and the output files of each skipped entry are
+        added to 'reused' instead.  The entries that do run are recorded in
+        'index' once wait() or poll() finds the job finished, along with
+        their Output and Error files, but only if every process of the entry
+        exited normally with return value 0.  Entries whose settings (other
+        than "Log") use the $(Cluster) or $(Process) macros always run, since
+        skipping other entries changes the process ids Condor hands out.
+        When the submit server is the local machine, an entry whose output
+        files have since disappeared runs again.  If 'index' is None,
+        memoization is turned off."""
+        self._results = index
+
+    def _fingerprint(self, arguments, times):
+        """_fingerprint(arguments, times) -> string
+        Returns the fingerprint of queueing the current settings with the
+        "Arguments" value 'arguments' 'times' times."""
+        settings = dict(self._settings)
+        settings.pop("notify_user", None)
+        settings.pop("notification", None)
+        settings["Arguments"] = arguments
+        names = [settings.get("Input"), settings.get("Executable")]
+        if "transfer_input_files" in settings:
+            names.extend([name.strip() for name in \
+                          settings["transfer_input_files"].split(",")])
+        inputs = dict([(name, staging._hash(name)) for name in names
+                       if name and os.path.isfile(name)])
+        return hashlib.sha256(json.dumps([settings, times, inputs],
+                                         sort_keys=True, default=str) \
+                              .encode("utf-8")).hexdigest()
+
+    def _dependsOnIds(self, items=None):
+        """_dependsOnIds(items=None) -> boolean
+        Returns whether queueing the current settings, with the argument
+        strings 'items' if given, uses the cluster or process id of the
+        processes anywhere but in the "Log" setting."""
+        values = [str(self._settings[key]) for key in self._settings
+                  if key != "Log"]
+        values.extend(items or [])
+        for macro in ("$(Cluster)", "$(ClusterId)", "$(Process)", "$(ProcId)"):
+            for value in values:
+                if macro in value:
+                    return True
+        return False
+
+    def _alreadyRan(self, fingerprint):
+        """_alreadyRan(fingerprint) -> boolean
+        Returns whether the entry 'fingerprint' already ran, remembering
+        its output files in 'reused' if so."""
+        outputs = self._results.get(fingerprint)
+        if outputs is None:
+            return False
+        if self._submitShell.local and \
+                not all([os.path.exists(path) for path in outputs]):
+            return False
+        self.reused.append(outputs)
+        return True
+
+    def _procOutputs(self, cluster, procId, settings,
+                     keys=("Output", "Error")):
+        """_procOutputs(cluster, procId, settings, keys=("Output", "Error")) -> [string, ...]
+        Returns the paths on the submit server of the files named by the
+        settings 'keys' of one process."""
+        paths = []
+        for key in keys:
+            if key in settings:
+                path = SubmitDescription.expandMacros(settings[key],
+                                                      cluster, procId)
+                if not path.startswith("/") and "initialdir" in settings:
+                    path = SubmitDescription.expandMacros( \
+                        settings["initialdir"], cluster, procId) \
+                        .rstrip("/") + "/" + path
+                paths.append(path)
+        return paths
+
+    def _recordResults(self):
+        """_recordResults()
+        Records every entry of the finished job that is not recorded yet in
+        the ResultIndex and whose processes all returned 0.  Entries with a
+        process that failed are never recorded, and entries with a process
+        whose return value is not known yet are tried again next time."""
+        if self._results is None \
+                or not [entry for entry in self._fingerprints if entry[0]]:
+            return
+        returnValues = self._returnValues()
+        procs = self._iterSubmittedProcs()
+        entries = []
+        for entry in self._fingerprints:
+            outputs = []
+            ids = []
+            for i in range(entry[1]):
+                (cluster, procId, settings) = next(procs)
+                ids.append((cluster, procId))
+                if entry[0] is not None and cluster is not None:
+                    outputs.extend(self._procOutputs(cluster, procId,
+                                                     settings))
+            if entry[0] is None or None in [c for (c, p) in ids]:
+                continue
+            if all([returnValues.get(i, 1) == 0 for i in ids]):
+                entries.append((entry[0], outputs))
+                entry[0] = None
+            elif all([i in returnValues for i in ids]):
+                # Finished, but not successfully, so it has to run again
+                entry[0] = None
+        if entries:
+            self._results.record(entries)
+
+    def _returnValues(self):
+        """_returnValues() -> dictionary
+        Returns the return values of the processes of the submitted job that
+        are known to have finished, keyed by (cluster, proc).  The value is
+        None for processes that were removed or killed.  They come from the
+        backend, or else from the user log and 'condor_history'."""
+        ids = [(cluster, procId)
+               for (cluster, procId, settings) in self._iterSubmittedProcs()
+               if cluster is not None]
+        if self._backend is not None:
+            return dict([(i, value) for (i, value) in
+                         zip(ids, self._backend.returnValues(self))
+                         if value is not None])
+        returnValues = {}
+        log = self._getUserLog()
+        if log is not None:
+            returnValues.update(log.returnValues)
+        if [i for i in ids if not i in returnValues]:
+            returnValues.update(self._historyReturnValues())
+        return returnValues
+
+    def _historyReturnValues(self):
+        """_historyReturnValues() -> dictionary
+        Returns the return values of the finished processes of the job
+        according to 'condor_history', like _returnValues()."""
+        clusters = [str(c) for c in self._activeClusters()]
+        (retval, msg) = self._submitShell.execute("condor_history " \
+                + "-constraint '" + " || ".join(["ClusterId == " + c
+                                                for c in clusters]) + "'" \
+                + " -af ClusterId ProcId JobStatus ExitCode",
+                idempotent=True)
+        returnValues = {}
+        if retval != 0:
+            return returnValues
+        for line in msg.splitlines():
+            fields = line.split()
+            if len(fields) != 4 or not fields[0].isdigit() \
+                    or not fields[1].isdigit():
+                continue
+            key = (int(fields[0]), int(fields[1]))
+            if fields[2] == str(ProcTable.COMPLETED) and fields[3].isdigit():
+                returnValues[key] = int(fields[3])
+            elif fields[2] in (str(ProcTable.COMPLETED),
+                               str(ProcTable.REMOVED)):
+                returnValues[key] = None
+        return returnValues
+
     def getWhenTransferOutput(self):
         """getWhenTransferOutput() -> string"""
         try:
@@ -657,6 +3155,7 @@ class Job(object):
 
     def getEmail(self):
         """getEmail() -> string"""
+        self._resolveEmail()
         try:
             return self._settings["notify_user"]
         except KeyError:
@@ -668,35 +3167,91 @@ class Job(object):
         the user, such as if the job runs into an error.  If no argument is
         supplied, a predefined list of email mappings will be used to
         automatically map the user's username to their preferred email
-        address."""
+        address.  This mapping is only read once the address is needed, and
+        at most once per user and server in each Python process."""
         if string:
             self._settings["notify_user"] = string
+            self._emailPending = False
         else:
-            # String empty or is None, so automatically detect email
-            (status, bytesOut) = self._submitShell.execute( \
-                    "cat /mnt/config/scripts/mail_map.pickle", returnBytes=True)
-            if status == 0:
-                emails = pickle.load(BytesIO(bytesOut))
-                try:
-                    self._settings["notify_user"] = emails[self.getUsername()]
-                except KeyError:
-                    print("Note:", self.getUsername(), "not in email mapping. ",
-                          "Using a default value.", file=sys.stderr)
-                    try:
-                        self._settings["notify_user"] = emails[None]
-                    except KeyError:
-                        self._settings["notify_user"] = "kollerg14@mail.wlu.edu"
-            
-
-    def _generateSubmitString(self, update=True):
-        """_generateSubmitString(update=True) -> submitString"""
-        allLines = self.submitLinesSoFar
-        for s in self._settings:
-            allLines += str(s) + " = " + str(self._settings[s]) + "\n"
+            # String empty or is None, so automatically detect email later
+            self._emailPending = True
+
+    def _resolveEmail(self):
+        """_resolveEmail()
+        Looks up the email address requested by setEmail(None), if any."""
+        if self._emailPending:
+            self._emailPending = False
+            email = environment.get("notify_user " + str(self.getUsername()) \
+                                    + "@" + str(self.getServer()),
+                                    self._lookupEmail)
+            if email:
+                self._settings["notify_user"] = email
+
+    def _lookupEmail(self):
+        """_lookupEmail() -> string
+        Looks up the address of this job's user in the email mapping on the
+        submit server (see MailMap) and returns it, a default address, or
+        None if the mapping could not be read, which 'environment' does not
+        remember, so other Jobs try again."""
+        emails = MailMap(self._submitShell)
+        try:
+            return emails.lookup(self.getUsername())
+        except IOError:
+            return None
+        except KeyError:
+            print("Note:", self.getUsername(), "not in email mapping. ",
+                  "Using a default value.", file=sys.stderr)
+            try:
+                return emails.lookup(None)
+            except KeyError:
+                return "kollerg14@mail.wlu.edu"
+
+    @property
+    def submitLinesSoFar(self):
+        """The submit description written by every queue() so far."""
+        return self._description.getvalue()
+
+    def _generateSubmitString(self, update=True, staged=True):
+        """_generateSubmitString(update=True, staged=True) -> submitString
+        Returns the whole submit description, including the settings that
+        were changed since the last queue().  If 'update' is True, those
+        settings are also written into the description for good.  If
+        'staged' is True, input files are staged and the description points
+        at the staged copies (see setStagingDirectory())."""
+        self._resolveEmail()
         if update:
-            self._settings.clear()
-            self.submitLinesSoFar = allLines
-        return allLines
+            self._description.addQueue(self._settings, None)
+        if not staged:
+            return self._description.getvalue(self._settings)
+        (description, settings) = self._stagedDescription(self._settings)
+        return description.getvalue(settings)
+
+    def _addQueue(self, times, items=None):
+        """_addQueue(times, items=None)
+        Writes the current settings and a Queue statement into the submit
+        description.  See SubmitDescription.addQueue()."""
+        self._resolveEmail()
+        if self._results is None or self._dependsOnIds(items):
+            # Skipping entries would renumber the processes of this one
+            procs = times * (len(items) if items is not None else 1)
+            self._fingerprints.append([None, procs])
+        elif items is None:
+            fingerprint = self._fingerprint(self._settings.get("Arguments"),
+                                            times)
+            if self._alreadyRan(fingerprint):
+                return
+            self._fingerprints.append([fingerprint, times])
+        else:
+            kept = []
+            for argStr in items:
+                fingerprint = self._fingerprint('"' + argStr + '"', times)
+                if not self._alreadyRan(fingerprint):
+                    kept.append(argStr)
+                    self._fingerprints.append([fingerprint, times])
+            if not kept:
+                return
+            items = kept
+        self._description.addQueue(self._settings, times, items)
 
     def saveSubmitFile(self, filename):
         """saveSubmitFile(filename)
@@ -706,9 +3261,13 @@ class Job(object):
         method after setting all of the desired variables and calling
         queue() for all of the desired commands, although this method
         can still be called after the job is submitted."""
+        self._resolveEmail()
         f = open(filename, 'w')
-        f.write(self._generateSubmitString(False))
-        f.close()
+        try:
+            (description, settings) = self._stagedDescription(self._settings)
+            description.writeTo(f, settings)
+        finally:
+            f.close()
 
     def queue(self, command_line, times=1):
         """queue(command_line, times=1)
@@ -720,32 +3279,54 @@ class Job(object):
         quote ("").  Instead, use single quotes (').  If you need nested
         single quotes, escape a nested single quote with another single
         quote ('')."""
+        (executable, argStr) = self._splitCommandLine(command_line)
+        self.setExecutable(executable)
+        if argStr:
+            self.setArguments(argStr)
+        # Set arguments in _settings
+        #allArgs = " ".join(args[1:])
+        #allArgs = ""
+        #for arg in args[1:]:
+        #    allArgs += " '" + arg.replace("'", "''").replace('"', '""') + "' "
+        #if allArgs:
+        #    self.setArguments(allArgs)
+        self._addQueue(times)
+
+    def queueMany(self, command_lines, times=1):
+        """queueMany(command_lines, times=1)
+        Enqueue every command line in the iterable 'command_lines', just as
+        calling queue() on each of them would, but write them to the submit
+        description compactly: the command lines are grouped by executable
+        and each group is a single Condor "queue arguments from (...)"
+        statement listing one line of arguments per command.  Note that
+        commands are therefore numbered (as Condor processes) group by
+        group.  The same quoting rules as for queue() apply."""
+        groups = OrderedDict()
+        for command_line in command_lines:
+            (executable, argStr) = self._splitCommandLine(command_line)
+            groups.setdefault(executable, []).append(argStr)
+        for executable in groups:
+            # Several executables are expected here, so don't warn about them
+            self._useExecutable(self._resolveExecutable(executable), False)
+            # The arguments come from the item list instead
+            self._settings.pop("Arguments", None)
+            self._addQueue(times, groups[executable])
+
+    def _splitCommandLine(self, command_line):
+        """_splitCommandLine(command_line) -> (executable, arguments)
+        Splits 'command_line' into the executable and the string of arguments
+        to pass to it, raising BadQuotes if it contains bad quoting."""
         #TODO
         # Remove leading or trailing spaces
         command_line = command_line.strip()
         if '"' in command_line.replace('""', ''):
             raise BadQuotes('"')
-        self.setExecutable(shlex.split(command_line)[0])
         args = command_line.split(" ")
         executable = args.pop(0)
         while executable.endswith("\\"):
             executable += args.pop(0)
         # The rest of args are the actual arguments to the executable
-        argStr = " ".join(args)
-        if argStr:
-            self.setArguments(argStr)
-        # Set arguments in _settings
-        #allArgs = " ".join(args[1:])
-        #allArgs = ""
-        #for arg in args[1:]:
-        #    allArgs += " '" + arg.replace("'", "''").replace('"', '""') + "' "
-        #if allArgs:
-        #    self.setArguments(allArgs)
-        self._generateSubmitString()
-        if times != 1:
-            self.submitLinesSoFar += "Queue " + str(times) + "\n"
-        else:
-            self.submitLinesSoFar += "Queue\n"
+        return (shlex.split(command_line)[0], " ".join(args))
 
     def submit(self):
         """submit() -> cluster_int
@@ -753,65 +3334,355 @@ class Job(object):
         specified Condor submit server.  Returns the cluster id if the job
         is submitted successfully or None if the job encounters an error in
         submission."""
+        if self._backend is not None:
+            self._resolveEmail()
+            cluster = self._backend.submit(self)
+            self.cluster = cluster
+            self.clusters = [cluster]
+            self.failedShards = {}
+            self._startedSubmission(None)
+            return cluster
         retval, msg = self._submitShell.execute( \
             "condor_submit -remote " + self.server, self._generateSubmitString())
-        if retval != 0:
-            print("ERROR #" + str(retval) + ":", file=sys.stderr)
-            print("WARNING: Since 'condor_submit' returned an error, your " \
-                  + "job was probably not submitted.  If your job submitted " \
-                  + "after all, this object will still not be able to " \
-                  + "monitor its status.", file=sys.stderr)
-            return None
-        print(msg)
-        clusterRE = re.search("(cluster )(\d+)", msg)
-        if clusterRE is None: raise BadFormatError("condor_submit")
-        clusterStr = clusterRE.group(2)
-        if not clusterStr.isdigit(): raise BadFormatError("condor_submit")
-        self.cluster = int(clusterStr)
-        return self.cluster
+        return self._parseSubmitOutput(retval, msg,
+                                       self._description.procCount())
+
+    def submitStream(self, entries, chunkSize=65536):
+        """submitStream(entries, chunkSize=65536) -> cluster_int
+        Like calling queue() for each entry of the iterable 'entries' and
+        then submit(), except that the submit description is written to
+        'condor_submit' piece by piece while 'entries' is being read, so it
+        never has to be held in memory all at once.  'entries' may be a
+        generator.  Each entry is either a command line or a tuple of a
+        command line and the number of times to run it.  Commands already
+        queued with queue() are submitted first.  The description is sent
+        in pieces of about 'chunkSize' characters and kept in a temporary
+        file on the submit server, and 'condor_submit' only runs once all of
+        it arrived, so nothing is submitted if reading 'entries' fails or
+        the connection drops partway through.  The Output, Error, Log and
+        initialdir settings of the entries are remembered, once for every
+        run of entries in which they do not change, so that
+        collectOutputs() and iterOutputs() find their files.  Entries are
+        neither skipped nor recorded by a ResultIndex (see
+        setResultIndex()).  A job with a Backend simply queues every entry
+        and is then submitted with submit()."""
+        if self._backend is not None:
+            for entry in entries:
+                if isinstance(entry, str):
+                    self.queue(entry)
+                else:
+                    self.queue(*entry)
+            return self.submit()
+        if self._results is not None:
+            print("Warning: submitStream() does not skip or record entries " \
+                  "that already ran.  Use queue() and submit() for that.",
+                  file=sys.stderr)
+        self._resolveEmail()
+        # Killing the local Process does not stop a command on the other end
+        # of SSH, which only sees its input end, so the description has to
+        # end with this line to be submitted at all
+        trailer = "# End of description " + uuid.uuid4().hex
+        p = self._submitShell.spawn('f=$(mktemp) || exit 1; cat > "$f"; ' \
+            + 'if [ "$(tail -n 1 "$f")" = ' + shlex.quote(trailer) + ' ]; ' \
+            + 'then condor_submit -remote ' + self.server + ' < "$f"; s=$?; ' \
+            + 'else echo "The submit description was cut short." >&2; s=1; ' \
+            + 'fi; rm -f "$f"; exit $s', family="condor_submit")
+        buffered = []
+        bufferedSize = 0
+        procs = self._description.procCount()
+        # [settings naming output files, processes] of every run of entries
+        streamed = []
+        try:
+            description = self._stagedDescription()[0]
+            for text in description.iterText():
+                p.put(text)
+            stream = description.fork()
+            for entry in entries:
+                if isinstance(entry, str):
+                    (command_line, times) = (entry, 1)
+                else:
+                    (command_line, times) = entry
+                (executable, argStr) = self._splitCommandLine(command_line)
+                self.setExecutable(executable)
+                if argStr:
+                    self.setArguments(argStr)
+                text = stream.queueText(self._stagedSettings(self._settings),
+                                        times)
+                procs += times
+                outputSettings = dict([(key, self._settings[key])
+                                       for key in self._outputKeys
+                                       if key in self._settings])
+                if streamed and streamed[-1][0] == outputSettings:
+                    streamed[-1][1] += times
+                else:
+                    streamed.append([outputSettings, times])
+                buffered.append(text)
+                bufferedSize += len(text)
+                if bufferedSize >= chunkSize:
+                    p.put("".join(buffered))
+                    buffered = []
+                    bufferedSize = 0
+            buffered.append("\n" + trailer + "\n")
+            p.put("".join(buffered))
+        except BaseException:
+            # Without the trailer nothing is submitted, however the input ends
+            p.kill()
+            p.wait()
+            p._closeInput()
+            raise
+        msg = p.get()
+        cluster = self._parseSubmitOutput(p.poll(), msg, procs)
+        if cluster is not None:
+            self._streamedProcs = streamed
+        return cluster
+
+    def _parseSubmitOutput(self, retval, msg, procs=None):
+        """_parseSubmitOutput(retval, msg, procs=None) -> cluster_int
+        Interprets the return value and output of 'condor_submit', remembers
+        the resulting cluster id and returns it, or None on an error.
+        'procs' is the number of processes that were submitted, if known."""
+        cluster = self._clusterFromOutput(retval, msg)
+        if cluster is not None:
+            self.cluster = cluster
+            self.clusters = [cluster]
+            self.failedShards = {}
+            self._startedSubmission(procs)
+        return cluster
+
+    def _startedSubmission(self, procs):
+        """_startedSubmission(procs)
+        Forgets the user log of an earlier submission and remembers that
+        'procs' processes (None if unknown) were just submitted."""
+        if self._userLog is not None:
+            self._userLog.close()
+            self._userLog = None
+        self._expectedProcs = procs
+        self._streamedProcs = []
+
+    def _clusterFromOutput(self, retval, msg):
+        """_clusterFromOutput(retval, msg) -> cluster_int
+        Returns the cluster id in the output of 'condor_submit', or None on
+        an error, without remembering it."""
+        return _parseClusterOutput(retval, msg, "condor_submit",
+            "your job was probably not submitted.  If your job submitted " \
+            + "after all, this object will still not be able to monitor " \
+            + "its status.")
+
+    def submitSharded(self, shardSize=1000, maxParallel=4):
+        """submitSharded(shardSize=1000, maxParallel=4) -> [cluster_int, ...]
+        Like submit(), but splits the queued processes into separate
+        clusters of at most 'shardSize' processes each and submits up to
+        'maxParallel' of them at the same time.  Returns the cluster id of
+        each shard in order, or None for shards that failed to submit; those
+        can be submitted again with retryFailedShards().  wait(), poll() and
+        status() then cover every cluster.  A job with a Backend is not
+        split, but submitted whole with submit()."""
+        if self._backend is not None:
+            return [self.submit()]
+        shards = list(self._stagedDescription()[0].iterShards(shardSize))
+        self.clusters = [None] * len(shards)
+        self.failedShards = dict(enumerate([text for (text, n) in shards]))
+        self._shardProcs = [n for (text, n) in shards]
+        self._startedSubmission(0)
+        return self.retryFailedShards(maxParallel)
+
+    def retryFailedShards(self, maxParallel=4):
+        """retryFailedShards(maxParallel=4) -> [cluster_int, ...]
+        Submits again only the shards of submitSharded() that failed, up to
+        'maxParallel' at a time, and returns the cluster ids of all shards."""
+        def submitShard(shard):
+            retval, msg = self._submitShell.execute( \
+                "condor_submit -remote " + self.server, shard)
+            return self._clusterFromOutput(retval, msg)
+        indices = sorted(self.failedShards)
+        pool = ThreadPoolExecutor(max(1, maxParallel))
+        try:
+            results = list(pool.map(submitShard,
+                                    [self.failedShards[i] for i in indices]))
+        finally:
+            pool.shutdown()
+        for (i, cluster) in zip(indices, results):
+            if cluster is not None:
+                self.clusters[i] = cluster
+                del self.failedShards[i]
+        self._expectedProcs = sum([self._shardProcs[i]
+                                   for i in range(len(self.clusters))
+                                   if self.clusters[i] is not None])
+        if self.failedShards:
+            print("WARNING:", len(self.failedShards), "of", len(self.clusters),
+                  "shards were not submitted.  Call retryFailedShards() to " \
+                  + "try them again.", file=sys.stderr)
+        submitted = self._activeClusters()
+        if submitted:
+            self.cluster = submitted[0]
+        return list(self.clusters)
+
+    def _activeClusters(self):
+        """_activeClusters() -> [cluster_int, ...]
+        Returns the ids of every cluster this job was submitted as."""
+        retval = [c for c in self.clusters if c is not None]
+        if not retval and self.cluster is not None:
+            retval = [self.cluster]
+        return retval
+
+    def _queueCommand(self):
+        """_queueCommand() -> string
+        Returns the 'condor_q' command that lists the processes of this job
+        that are still in the queue."""
+        return 'condor_q ' + " ".join([str(c) for c in self._activeClusters()]) \
+               + ' -format "%d." ClusterId -format "%d\n" ProcId'
+
+    def _countQueued(self, msg):
+        """_countQueued(msg) -> int
+        Returns how many processes of this job are listed in the output of
+        the command from _queueCommand()."""
+        clusters = set([str(c) for c in self._activeClusters()])
+        count = 0
+        for line in msg.split():
+            if line.partition(".")[0] in clusters:
+                count += 1
+        return count
 
     def _checkQueue(self):
         """_checkQueue() -> string"""
         if self.cluster:
-            return self._submitShell.execute( \
-                    'condor_q ' + str(self.cluster) \
-                    + ' -format "%d." ClusterId -format "%d\n" ProcId')
+            return self._submitShell.execute(self._queueCommand(),
+                                             idempotent=True)
         else:
             raise SubmissionError("_checkQueue()")
 
+    def waitFuture(self):
+        """waitFuture() -> concurrent.futures.Future
+        Returns immediately with a Future that resolves to this Job once all
+        of its processes have finished, without printing anything.  All
+        Futures are resolved by the shared background thread of the
+        module's WaitScheduler, 'waitScheduler', except for jobs run by a
+        Backend, which are waited for by a thread of their own.  If the job
+        hasn't been submitted yet, raises a SubmissionError."""
+        if self.cluster is None:
+            raise SubmissionError("waitFuture()")
+        if self._backend is None:
+            return waitScheduler.add(self)
+        future = Future()
+        def waitForBackend():
+            try:
+                self.wait()
+            except BaseException as e:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            else:
+                if future.set_running_or_notify_cancel():
+                    future.set_result(self)
+        thread = threading.Thread(target=waitForBackend)
+        thread.daemon = True
+        thread.start()
+        return future
+
+    def _getUserLog(self):
+        """_getUserLog() -> UserLog
+        Returns the UserLog of the submitted job, or None if the job has no
+        log, 'followLog' is False, the number of submitted processes is
+        unknown or the processes do not all share one log (because its name
+        depends on the process id, or on the cluster id of a job submitted
+        as several clusters)."""
+        if not self.followLog or not "Log" in self._settings \
+                or self._expectedProcs is None:
+            return None
+        if self._userLog is None:
+            clusters = self._activeClusters()
+            path = self._settings["Log"]
+            if not path.startswith("/") and "initialdir" in self._settings:
+                path = self._settings["initialdir"].rstrip("/") + "/" + path
+            expanded = SubmitDescription.expandMacros(path, clusters[0], 0)
+            if expanded != SubmitDescription.expandMacros(path, clusters[0], 1) \
+                    or (len(clusters) > 1 and expanded != \
+                        SubmitDescription.expandMacros(path, clusters[1], 0)):
+                return None
+            self._userLog = UserLog(expanded, self._submitShell)
+        return self._userLog
+
     def wait(self):
         """wait()
         Waits for all processes of the submitted job to finish before
         returning.  If the job hasn't been submitted yet, raises a
-        SubmissionError."""
+        SubmissionError.  If a log was set with setLog(), the log is followed
+        to notice that the job finished within a second without asking
+        'condor_q'; 'condor_q' is then only checked every 'maxPollTime'
+        seconds in case the log cannot be read."""
         currPollTime = 1.0
         if self.cluster is None:
             raise SubmissionError("wait()")
+        if self._backend is not None:
+            self._backend.wait(self)
+            self._recordResults()
+            return
+        log = self._getUserLog()
+        if log is not None:
+            self._waitForLog(log)
+            self._recordResults()
+            return
         (retval, msg) = self._checkQueue()
         if msg.strip(): print("Waiting for cluster " + str(self.cluster) \
                               + " to finish", end='')
-        while str(self.cluster) in msg.strip():
+        while self._countQueued(msg):
             if retval != 0:
-                print("ERROR #" + str(retval) + ":", str(mesg), file=sys.stderr)
+                print("ERROR #" + str(retval) + ":", str(msg), file=sys.stderr)
             print('.', end='')
             sleep(min(currPollTime, self.maxPollTime))
             currPollTime += 0.5
             (retval, msg) = self._checkQueue()
         print()
+        self._recordResults()
+
+    def _waitForLog(self, log):
+        """_waitForLog(log)
+        The part of wait() that follows the UserLog 'log'."""
+        print("Waiting for cluster " + str(self.cluster) + " to finish",
+              end='')
+        lastQueueCheck = time()
+        log.read()
+        while log.remaining(self._activeClusters(), self._expectedProcs):
+            sleep(0.5)
+            if log.read():
+                print('.', end='')
+            if time() - lastQueueCheck >= self.maxPollTime:
+                lastQueueCheck = time()
+                (retval, msg) = self._checkQueue()
+                if retval == 0 and not self._countQueued(msg):
+                    break
+        log.close()
+        print()
 
     def poll(self):
         """poll() -> runningProcesses_int
         Returns the number of processes still running in this job.  Unlike
         wait(), poll() is non-blocking and so returns immediately.  If the job
-        hasn't been submitted yet, raises a SubmissionError."""
+        hasn't been submitted yet, raises a SubmissionError.  If a log was set
+        with setLog(), the answer comes from the log instead of 'condor_q'
+        once the log has any events of the job."""
         if self.cluster is None:
             raise SubmissionError("poll()")
-        (retval, msg) = self._checkQueue()
-        if retval != 0:
-            print("ERROR #" + str(retval) + ":", str(mesg), file=sys.stderr)
-            raise BadFormatError("condor_q")
+        if self._backend is not None:
+            remaining = self._backend.poll(self)
         else:
-            return msg.count(str(self.cluster) + '.')
+            log = self._getUserLog()
+            remaining = None
+            if log is not None:
+                log.read()
+                if log.seen(self._activeClusters()):
+                    remaining = log.remaining(self._activeClusters(),
+                                              self._expectedProcs)
+            if remaining is None:
+                # No log, or nothing in it yet (it may not be readable)
+                (retval, msg) = self._checkQueue()
+                if retval != 0:
+                    print("ERROR #" + str(retval) + ":", str(msg),
+                          file=sys.stderr)
+                    raise BadFormatError("condor_q")
+                remaining = self._countQueued(msg)
+        if not remaining:
+            self._recordResults()
+        return remaining
 
     def status(self, outputFn=print):
         """status(outputFn=print) -> [retval of outputFn()]
@@ -824,14 +3695,623 @@ class Job(object):
         raised."""
         if self.cluster is None:
             raise SubmissionError("status()")
+        if self._backend is not None:
+            return outputFn(self._backend.status(self))
         (retval, msg) = self._submitShell.execute( \
-                'condor_q ' + str(self.cluster))
+                'condor_q ' + " ".join([str(c) for c in self._activeClusters()]),
+                idempotent=True)
         if retval != 0:
-            print("ERROR #" + str(retval) + ":", str(mesg), file=sys.stderr)
+            print("ERROR #" + str(retval) + ":", str(msg), file=sys.stderr)
             raise BadFormatError("condor_q")
         else:
             return outputFn(msg)
 
+    def statusTable(self):
+        """statusTable() -> ProcTable
+        Returns a ProcTable with the status, wall clock time and image size
+        of every process of the job still in the queue.  The output of
+        'condor_q' is parsed line by line as it arrives.  If the job has not
+        been submitted yet, a SubmissionError is raised."""
+        if self.cluster is None:
+            raise SubmissionError("statusTable()")
+        p = self._submitShell.spawn('condor_q ' \
+                + " ".join([str(c) for c in self._activeClusters()]) \
+                + ' -af ' + " ".join(ProcTable.attributes))
+        table = ProcTable.fromLines(p.iterLines())
+        if p.returncode != 0:
+            print("ERROR #" + str(p.returncode) + ": condor_q failed.",
+                  file=sys.stderr)
+            raise BadFormatError("condor_q")
+        return table
+
+    def _iterSubmittedProcs(self):
+        """_iterSubmittedProcs() -> iterator of (cluster_int, proc_int, dictionary)
+        Yields the cluster id, process id and settings in effect of every
+        queued process (see SubmitDescription.iterProcs()), followed by those
+        of the entries of submitStream(), whose settings only hold the ones
+        naming output files.  The cluster id of processes of shards that
+        failed to submit is None."""
+        if self._shardProcs and len(self._shardProcs) == len(self.clusters):
+            shardSizes = self._shardProcs
+            clusters = self.clusters
+        else:
+            shardSizes = [None]
+            clusters = [self.cluster]
+        shard = 0
+        procId = 0
+        for (settings, argStr) in self._description.iterProcs():
+            if shardSizes[shard] is not None and procId >= shardSizes[shard]:
+                shard += 1
+                procId = 0
+            yield (clusters[shard], procId, settings)
+            procId += 1
+        for (settings, count) in self._streamedProcs:
+            for i in range(count):
+                yield (clusters[shard], procId, settings)
+                procId += 1
+
+    def _outputPaths(self):
+        """_outputPaths() -> [string, ...]
+        Returns the paths on the submit server of the Output, Error and Log
+        files of every submitted process, without duplicates."""
+        paths = OrderedDict()
+        for (cluster, procId, settings) in self._iterSubmittedProcs():
+            if cluster is None:
+                continue
+            for path in self._procOutputs(cluster, procId, settings,
+                                          ("Output", "Error", "Log")):
+                paths[path] = True
+        return list(paths)
+
+    def _outputArchive(self):
+        """_outputArchive() -> tarfile.TarFile
+        Starts packing the output files of the job into a compressed tar
+        stream on the submit server and returns it, opened for reading one
+        file after another as they arrive."""
+        if self.cluster is None:
+            raise SubmissionError("collectOutputs()")
+        p = self._submitShell.spawn("tar czf - --ignore-failed-read -T -",
+                                    True)
+        p.put("".join([path + "\n" for path in self._outputPaths()]))
+        return tarfile.open(fileobj=p.outputStream(), mode="r|gz")
+
+    def iterOutputs(self):
+        """iterOutputs() -> iterator of (string, file object)
+        Fetches the Output, Error and Log files of every submitted process
+        from the submit server in a single compressed stream and yields the
+        name and contents of each one as it arrives.  Each file object must
+        be read before moving on to the next file.  Missing files are
+        skipped.  If the job hasn't been submitted yet, raises a
+        SubmissionError."""
+        archive = self._outputArchive()
+        try:
+            for member in archive:
+                if member.isfile():
+                    yield (member.name, archive.extractfile(member))
+        finally:
+            archive.close()
+
+    def collectOutputs(self, destination="."):
+        """collectOutputs(destination=".") -> [string, ...]
+        Fetches the Output, Error and Log files of every submitted process
+        from the submit server in a single compressed stream and unpacks
+        them under the directory 'destination' as they arrive, keeping their
+        paths.  Returns the names of the files.  Missing files are skipped.
+        If the job hasn't been submitted yet, raises a SubmissionError."""
+        names = []
+        archive = self._outputArchive()
+        try:
+            for member in archive:
+                if member.isfile():
+                    if hasattr(tarfile, "data_filter"):
+                        archive.extract(member, destination, filter="data")
+                    else:
+                        archive.extract(member, destination)
+                    names.append(member.name)
+        finally:
+            archive.close()
+        return names
+
+    async def _getAsyncShell(self, shell=None):
+        """_getAsyncShell(shell=None) -> AsyncShell
+        A coroutine returning 'shell' if one is given, or else an AsyncShell
+        that runs commands wherever this job's submit shell does.  Setting up
+        the submit shell may probe the environment, which happens outside
+        the event loop."""
+        if shell is not None:
+            return shell
+        if self._asyncSubmitShell is None:
+            submitShell = await _runInThread(lambda: self._submitShell)
+            self._asyncSubmitShell = AsyncShell.fromShell(submitShell)
+        return self._asyncSubmitShell
+
+    async def submitAsync(self, shell=None):
+        """submitAsync(shell=None) -> cluster_int
+        A coroutine version of submit() that does not block the event loop.
+        If an AsyncShell 'shell' is given, the submission runs through it
+        instead of this job's own submit shell, so that one AsyncShell with a
+        'maxConcurrent' limit can be shared by many jobs.  A job with a
+        Backend is started by the backend instead."""
+        if self._backend is not None:
+            return await _runInThread(self.submit)
+        shell = await self._getAsyncShell(shell)
+        # Looking up the email address and staging input files block
+        text = await _runInThread(self._generateSubmitString)
+        retval, msg = await shell.execute("condor_submit -remote " \
+                                          + self.server, text)
+        return self._parseSubmitOutput(retval, msg)
+
+    async def pollAsync(self, shell=None):
+        """pollAsync(shell=None) -> runningProcesses_int
+        A coroutine version of poll().  See submitAsync() for 'shell'."""
+        if self.cluster is None:
+            raise SubmissionError("pollAsync()")
+        if self._backend is not None:
+            return await _runInThread(self.poll)
+        shell = await self._getAsyncShell(shell)
+        (retval, msg) = await shell.execute(self._queueCommand(),
+                                            idempotent=True)
+        if retval != 0:
+            print("ERROR #" + str(retval) + ":", str(msg), file=sys.stderr)
+            raise BadFormatError("condor_q")
+        remaining = self._countQueued(msg)
+        if not remaining:
+            await _runInThread(self._recordResults)
+        return remaining
+
+    async def waitAsync(self, shell=None):
+        """waitAsync(shell=None)
+        A coroutine version of wait() that lets other tasks run while it
+        sleeps between checks of the queue.  Unlike wait(), it does not print
+        its progress.  See submitAsync() for 'shell'.  A job with a Backend
+        is checked on through the backend instead."""
+        currPollTime = 1.0
+        if self.cluster is None:
+            raise SubmissionError("waitAsync()")
+        if self._backend is not None:
+            while await _runInThread(self.poll):
+                await asyncio.sleep(min(currPollTime, self.maxPollTime))
+                currPollTime += 0.5
+            return
+        shell = await self._getAsyncShell(shell)
+        (retval, msg) = await shell.execute(self._queueCommand(),
+                                            idempotent=True)
+        # A failed 'condor_q' says nothing about whether the job finished
+        while retval != 0 or self._countQueued(msg):
+            if retval != 0:
+                print("ERROR #" + str(retval) + ":", str(msg), file=sys.stderr)
+            await asyncio.sleep(min(currPollTime, self.maxPollTime))
+            currPollTime += 0.5
+            (retval, msg) = await shell.execute(self._queueCommand(),
+                                            idempotent=True)
+        await _runInThread(self._recordResults)
+
+
+
+class JobMonitor(object):
+    """JobMonitor(shell=None, byOwner=False)
+    Watches many submitted Jobs (or bare cluster ids) at once.  Each refresh
+    asks 'condor_q' about all of them with a single query per submit shell,
+    instead of one query per Job.  Cluster ids registered without a Shell
+    are looked up through 'shell', or the local machine if it is None.  If
+    'byOwner' is True, the query simply lists all of the user's jobs rather
+    than naming every cluster, which is shorter when there are very many."""
+
+    def __init__(self, shell=None, byOwner=False):
+        if shell is None:
+            shell = Shell()
+        self.shell = shell
+        self.byOwner = byOwner
+        self.maxPollTime = 30.0
+        # str(shell) -> Shell
+        self._shells = {}
+        # cluster -> str(shell) of every cluster still in the queue
+        self._pending = OrderedDict()
+        # cluster -> number of its processes still in the queue
+        self.remaining = {}
+        # cluster -> the Job it belongs to, if it was registered as a Job
+        self.jobs = {}
+        # clusters found to have finished, in the order they finished
+        self.completed = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def register(self, job, shell=None):
+        """register(job, shell=None)
+        Starts watching the submitted Job 'job', or, if 'job' is an integer,
+        the cluster with that id on the Shell 'shell'."""
+        if isinstance(job, Job):
+            if job.cluster is None:
+                raise SubmissionError("register()")
+            clusters = job._activeClusters()
+            shell = job._submitShell
+        else:
+            clusters = [int(job)]
+            job = None
+            if shell is None:
+                shell = self.shell
+        self._shells[str(shell)] = shell
+        for cluster in clusters:
+            self._pending[cluster] = str(shell)
+            if job is not None:
+                self.jobs[cluster] = job
+
+    def unregister(self, cluster):
+        """unregister(cluster)
+        Stops watching the cluster with the id 'cluster'."""
+        self._pending.pop(cluster, None)
+        self.jobs.pop(cluster, None)
+
+    def _queryCommand(self, clusters):
+        """_queryCommand(clusters) -> string
+        Returns the 'condor_q' command listing the processes of 'clusters'
+        that are still in the queue."""
+        command = "condor_q"
+        if not self.byOwner:
+            command += " -constraint '" \
+                       + " || ".join(["ClusterId == " + str(c)
+                                      for c in clusters]) + "'"
+        return command + ' -format "%d." ClusterId -format "%d\n" ProcId'
+
+    def refresh(self):
+        """refresh() -> [cluster_int, ...]
+        Checks the queue once and returns the clusters that are found to
+        have finished since the last check."""
+        finished = []
+        for shellName in self._shells:
+            clusters = [c for c in self._pending
+                        if self._pending[c] == shellName]
+            if not clusters:
+                continue
+            (retval, msg) = self._shells[shellName].execute( \
+                    self._queryCommand(clusters), idempotent=True)
+            if retval != 0:
+                print("ERROR #" + str(retval) + ":", str(msg), file=sys.stderr)
+                continue
+            counts = dict.fromkeys(clusters, 0)
+            for line in msg.split():
+                cluster = line.partition(".")[0]
+                if cluster.isdigit() and int(cluster) in counts:
+                    counts[int(cluster)] += 1
+            for cluster in clusters:
+                self.remaining[cluster] = counts[cluster]
+                if not counts[cluster]:
+                    del self._pending[cluster]
+                    finished.append(cluster)
+        self.completed.extend(finished)
+        return finished
+
+    def iterCompleted(self):
+        """iterCompleted() -> iterator of cluster_int
+        Yields every watched cluster as soon as it is found to have finished,
+        checking the queue less and less often while nothing changes."""
+        currPollTime = 1.0
+        while self._pending:
+            finished = self.refresh()
+            for cluster in finished:
+                yield cluster
+            if finished:
+                currPollTime = 1.0
+            elif self._pending:
+                sleep(min(currPollTime, self.maxPollTime))
+                currPollTime += 0.5
+
+    def waitAny(self):
+        """waitAny() -> cluster_int
+        Waits until at least one watched cluster finishes and returns it, or
+        returns None if no clusters are being watched."""
+        for cluster in self.iterCompleted():
+            return cluster
+        return None
+
+    def waitAll(self):
+        """waitAll() -> [cluster_int, ...]
+        Waits until every watched cluster finishes and returns them in the
+        order they finished."""
+        return list(self.iterCompleted())
+
+
+class Workflow(object):
+    """Workflow(name="workflow", directory=None)
+    Runs several Jobs that depend on each other as a single Condor DAGMan
+    workflow, so that every stage starts as soon as the stages it depends on
+    have finished, without this program having to wait in between or even
+    stay running.  Each Job contributes its submit description as one node
+    of the DAG.  The submit files and the DAG file are written to
+    'directory' on the submit server (relative to the home directory unless
+    absolute, and "<name>" by default), and relative paths in the Jobs'
+    settings are relative to it.  Every Job must use the same submit server,
+    and 'condor_submit_dag' is run there."""
+
+    def __init__(self, name="workflow", directory=None):
+        self.name = name
+        if directory is None:
+            directory = name
+        self.directory = directory
+        self.maxPollTime = 30.0
+        # node name -> Job, in the order they were added
+        self._nodes = OrderedDict()
+        # node name -> [parent node name, ...]
+        self._parents = {}
+        # node name -> number of retries
+        self._retries = {}
+        # Cluster id of the DAGMan job running the workflow
+        self.cluster = None
+        self._shell = None
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _nodeName(self, node):
+        """_nodeName(node) -> string
+        Returns the name of the node 'node', given either as a name or as a
+        Job that was added."""
+        if isinstance(node, Job):
+            for name in self._nodes:
+                if self._nodes[name] is node:
+                    return name
+            raise KeyError("Job not in workflow: " + str(node))
+        if not node in self._nodes:
+            raise KeyError("No node named " + str(node))
+        return node
+
+    def add(self, job, name=None, parents=(), retry=0):
+        """add(job, name=None, parents=(), retry=0) -> string
+        Adds the Job 'job' (with everything queued in it so far) as a node
+        of the workflow and returns its name, which is "job<number>" unless
+        'name' is given.  The node only starts once every node in 'parents'
+        (given as Jobs or names) has finished successfully.  If 'retry' is
+        given, DAGMan runs a failed node again up to that many times."""
+        if name is None:
+            name = "job" + str(len(self._nodes))
+        if name in self._nodes:
+            raise KeyError("A node named " + name + " already exists")
+        parentNames = [self._nodeName(parent) for parent in parents]
+        self._nodes[name] = job
+        self._parents[name] = parentNames
+        if retry:
+            self._retries[name] = int(retry)
+        return name
+
+    def _submitFileName(self, name):
+        """_submitFileName(name) -> string
+        Returns the name of the submit file of the node 'name'."""
+        return self.name + "." + name + ".sub"
+
+    def getDAG(self):
+        """getDAG() -> string
+        Returns the text of the DAGMan description of the workflow."""
+        lines = []
+        for name in self._nodes:
+            lines.append("JOB " + name + " " + self._submitFileName(name)
+                         + "\n")
+        for name in self._nodes:
+            if self._parents[name]:
+                lines.append("PARENT " + " ".join(self._parents[name])
+                             + " CHILD " + name + "\n")
+        for name in self._retries:
+            lines.append("RETRY " + name + " " + str(self._retries[name])
+                         + "\n")
+        return "".join(lines)
+
+    def _archive(self):
+        """_archive() -> bytes
+        Returns a tar archive of the DAG file and the submit file of every
+        node."""
+        files = [(self.name + ".dag", self.getDAG())]
+        for name in self._nodes:
+            files.append((self._submitFileName(name),
+                          self._nodes[name]._generateSubmitString(False)))
+        buffer = BytesIO()
+        archive = tarfile.open(fileobj=buffer, mode="w")
+        for (fileName, text) in files:
+            data = text.encode(Process.defaultEncoding)
+            info = tarfile.TarInfo(fileName)
+            info.size = len(data)
+            info.mtime = time()
+            info.mode = 0o644
+            archive.addfile(info, BytesIO(data))
+        archive.close()
+        return buffer.getvalue()
+
+    def submit(self):
+        """submit() -> cluster_int
+        Writes the DAG file and the submit file of every node to the submit
+        server and submits the workflow with 'condor_submit_dag', all in a
+        single round trip.  Returns the cluster id of the DAGMan job that
+        runs the workflow, or None on an error."""
+        if not self._nodes:
+            raise RequiredSetting("Workflow node")
+        shells = set([str(job._submitShell) for job in self._nodes.values()])
+        if len(shells) > 1:
+            raise SettingError("Every Job of a Workflow must use the same " \
+                               + "submit server.")
+        self._shell = list(self._nodes.values())[0]._submitShell
+        directory = StagingCache._remoteDirectory(self.directory)
+        retval, msg = self._shell.execute("mkdir -p " + directory \
+            + " && cd " + directory + " && tar xf - && condor_submit_dag" \
+            + " -force " + shlex.quote(self.name + ".dag"), self._archive(),
+            family="condor_submit_dag")
+        cluster = _parseClusterOutput(retval, msg, "condor_submit_dag",
+                                      "your workflow was probably not " \
+                                      + "submitted.")
+        if cluster is not None:
+            self.cluster = cluster
+        return cluster
+
+    def _queueCommand(self):
+        """_queueCommand() -> string
+        Returns the 'condor_q' command that lists the DAGMan job and every
+        node process of the workflow still in the queue."""
+        return "condor_q -constraint 'ClusterId == " + str(self.cluster) \
+               + " || DAGManJobId == " + str(self.cluster) + "'" \
+               + ' -format "%d." ClusterId -format "%d\n" ProcId'
+
+    def poll(self):
+        """poll() -> runningProcesses_int
+        Returns the number of processes of the workflow still in the queue,
+        counting the DAGMan job itself, with a single query.  If the
+        workflow hasn't been submitted yet, raises a SubmissionError."""
+        if self.cluster is None:
+            raise SubmissionError("poll()")
+        (retval, msg) = self._shell.execute(self._queueCommand(),
+                                            idempotent=True)
+        if retval != 0:
+            print("ERROR #" + str(retval) + ":", str(msg), file=sys.stderr)
+            raise BadFormatError("condor_q")
+        return len(msg.split())
+
+    def wait(self):
+        """wait()
+        Waits for the whole workflow to finish, which is when its DAGMan job
+        leaves the queue.  If the workflow hasn't been submitted yet, raises
+        a SubmissionError."""
+        if self.cluster is None:
+            raise SubmissionError("wait()")
+        monitor = JobMonitor(self._shell)
+        monitor.maxPollTime = self.maxPollTime
+        monitor.register(self.cluster, self._shell)
+        print("Waiting for workflow " + str(self.cluster) + " to finish")
+        monitor.waitAll()
+
+
+class WaitScheduler(object):
+    """WaitScheduler(minPollTime=1.0, maxPollTime=30.0, jitter=0.2)
+    Resolves the Futures returned by Job.waitFuture() from a single
+    background thread, which checks on every waiting Job with one JobMonitor
+    refresh per round.  While the queue keeps changing, it checks every
+    'minPollTime' seconds; while nothing changes, the time between checks
+    doubles up to 'maxPollTime' seconds.  Every wait is randomly lengthened
+    or shortened by up to the fraction 'jitter', so that many drivers do not
+    all ask the scheduler at the same moment."""
+
+    def __init__(self, minPollTime=1.0, maxPollTime=30.0, jitter=0.2):
+        self.minPollTime = minPollTime
+        self.maxPollTime = maxPollTime
+        self.jitter = jitter
+        # Only used by the background thread, so queries run unlocked
+        self._monitor = JobMonitor()
+        # future -> (job, set of its clusters still in the queue) of every
+        # Future not resolved yet; a cluster may be waited for many times
+        self._waiting = {}
+        # (job, future) added since the last check, for the thread to register
+        self._added = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def add(self, job):
+        """add(job) -> concurrent.futures.Future
+        Returns a Future that resolves to the submitted Job 'job' once all of
+        its processes have left the queue."""
+        if job.cluster is None:
+            raise SubmissionError("add()")
+        future = Future()
+        with self._lock:
+            self._added.append((job, future))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        # Check on the new job soon
+        self._wakeup.set()
+        return future
+
+    def _resolve(self, job, future):
+        """_resolve(job, future)
+        Sets the result of 'future' to 'job', unless it was cancelled."""
+        try:
+            if future.set_running_or_notify_cancel():
+                future.set_result(job)
+        except Exception:
+            # Already resolved
+            pass
+
+    def _step(self):
+        """_step() -> int
+        Checks the queue once, resolves the Futures of finished Jobs and
+        returns the number of processes still in the queue.  The lock is
+        not held while the queue is checked, so add() never waits for it."""
+        with self._lock:
+            added = self._added
+            self._added = []
+            for (job, future) in added:
+                self._monitor.register(job)
+                self._waiting[future] = (job, set(job._activeClusters()))
+            cancelled = [future for future in self._waiting
+                         if future.cancelled()]
+            for future in cancelled:
+                del self._waiting[future]
+            if cancelled:
+                stillWaited = self._waitedClusters()
+                for cluster in list(self._monitor._pending):
+                    if not cluster in stillWaited:
+                        self._monitor.unregister(cluster)
+        finished = set(self._monitor.refresh())
+        with self._lock:
+            for future in list(self._waiting):
+                (job, clusters) = self._waiting[future]
+                clusters -= finished
+                if not clusters:
+                    del self._waiting[future]
+                    self._resolve(job, future)
+            return sum([self._monitor.remaining.get(c, 0)
+                        for c in self._waitedClusters()])
+
+    def _waitedClusters(self):
+        """_waitedClusters() -> set of cluster_int
+        Returns every cluster some unresolved Future is waiting for."""
+        clusters = set()
+        for (job, jobClusters) in self._waiting.values():
+            clusters.update(jobClusters)
+        return clusters
+
+    def _run(self):
+        """_run()
+        The body of the background thread."""
+        pollTime = self.minPollTime
+        lastRemaining = None
+        while True:
+            self._wakeup.clear()
+            try:
+                remaining = self._step()
+            except Exception as e:
+                # The queue could not be checked at all, so nobody can be
+                # told when their job finishes
+                with self._lock:
+                    waiting = [(job, future) for (future, (job, clusters))
+                               in self._waiting.items()] + self._added
+                    for cluster in self._waitedClusters():
+                        self._monitor.unregister(cluster)
+                    self._waiting.clear()
+                    self._added = []
+                    self._thread = None
+                for (job, future) in waiting:
+                    try:
+                        if future.set_running_or_notify_cancel():
+                            future.set_exception(e)
+                    except Exception:
+                        pass
+                return
+            with self._lock:
+                if not self._waiting and not self._added:
+                    self._thread = None
+                    return
+            if lastRemaining is None or remaining < lastRemaining:
+                # The queue is moving, so keep a close eye on it
+                pollTime = self.minPollTime
+            else:
+                pollTime = min(pollTime * 2, self.maxPollTime)
+            lastRemaining = remaining
+            delay = pollTime * random.uniform(1 - self.jitter, 1 + self.jitter)
+            if self._wakeup.wait(delay):
+                # A job was added, so start again at the shortest wait
+                pollTime = self.minPollTime
+                lastRemaining = None
+
+# The scheduler behind Job.waitFuture()
+waitScheduler = WaitScheduler()
 
 
 def test():
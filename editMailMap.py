@@ -5,20 +5,85 @@ Script to edit the mail mapping file: '/mnt/config/scripts/mail_map.pickle'
 Python 3.1.2
 """
 
+import os
 import pickle
+import fcntl
+
+mailMapPath = "/mnt/config/scripts/mail_map.pickle"
 
 emails = None
 
+def _lock():
+    """_lock() -> lockFile
+    Waits until no one else is changing the mail mapping and returns the
+    lock file, which must be closed to let others change it again."""
+    lockFile = open(mailMapPath + ".lock", 'a')
+    fcntl.flock(lockFile, fcntl.LOCK_EX)
+    return lockFile
+
+def _load():
+    """_load() -> dictionary
+    Reads the mail mapping file."""
+    f = open(mailMapPath, 'rb')
+    try:
+        return pickle.load(f)
+    finally:
+        f.close()
+
+def _save(mapping):
+    """_save(mapping)
+    Replaces the mail mapping file with 'mapping' in one step, so that anyone
+    reading it at the same time sees either the old or the new mapping and
+    never a half written file."""
+    tempName = mailMapPath + "." + str(os.getpid()) + ".tmp"
+    f = open(tempName, 'wb')
+    try:
+        pickle.dump(mapping, f)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.chmod(tempName, os.stat(mailMapPath).st_mode & 0o7777)
+    os.replace(tempName, mailMapPath)
+
 def readEmails():
     global emails
-    f = open("/mnt/config/scripts/mail_map.pickle", 'rb')
-    emails = pickle.load(f)
-    f.close()
+    emails = _load()
 
 def storeEmails():
-    f = open("/mnt/config/scripts/mail_map.pickle", 'wb')
-    pickle.dump(emails, f)
-    f.close()
+    lockFile = _lock()
+    try:
+        _save(emails)
+    finally:
+        lockFile.close()
+
+def setEmail(username, email):
+    """setEmail(username, email)
+    Maps 'username' to 'email' in the mail mapping file right away, keeping
+    any changes others made to other users in the meantime."""
+    lockFile = _lock()
+    try:
+        mapping = _load()
+        mapping[username] = email
+        _save(mapping)
+    finally:
+        lockFile.close()
+    if emails is not None:
+        emails[username] = email
+
+def removeEmail(username):
+    """removeEmail(username)
+    Removes 'username' from the mail mapping file right away, keeping any
+    changes others made to other users in the meantime."""
+    lockFile = _lock()
+    try:
+        mapping = _load()
+        mapping.pop(username, None)
+        _save(mapping)
+    finally:
+        lockFile.close()
+    if emails is not None:
+        emails.pop(username, None)
 
 def main():
     readEmails()
@@ -26,6 +91,8 @@ def main():
     print(str(emails).replace(', ', '\n ').replace(': ', ':\t'), end='\n\n')
     print("Change this dictionary as you see fit as you would a normal\n" \
           + "dictionary (of strings).  When you are done modifying 'emails',\n" \
-          + "simply run 'storeEmails()' to save your changes.")
+          + "simply run 'storeEmails()' to save your changes.  To change a\n" \
+          + "single user without touching anyone else, run\n" \
+          + "'setEmail(username, email)' or 'removeEmail(username)' instead.")
 
 main()
@@ -0,0 +1,108 @@
+"""
+Tests of Job.setResultIndex() that run entirely on the local machine.
+Python 3
+
+Jobs run with a LocalBackend in a temporary directory, so no Condor pool is
+needed.  Run with "python3 -m unittest test_memoization" or pytest.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import condor
+
+class MemoizationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.oldDirectory = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        self.index = condor.ResultIndex(os.path.join(self.directory,
+                                                     "results.sqlite"))
+
+    def tearDown(self):
+        self.index.close()
+        os.chdir(self.oldDirectory)
+        shutil.rmtree(self.directory)
+
+    def makeJob(self):
+        job = condor.Job(username="tester", server="localhost",
+                         backend=condor.LocalBackend(2))
+        job.setResultIndex(self.index)
+        return job
+
+    def runJob(self, entries):
+        """Queues the (output, command line) pairs 'entries', runs them and
+        returns the Job."""
+        job = self.makeJob()
+        for (output, command_line) in entries:
+            job.setOutput(output)
+            job.queue(command_line)
+        if len(job._description):
+            job.submit()
+            job.wait()
+        return job
+
+    def testSuccessfulEntriesAreReused(self):
+        self.runJob([("a.out", "/bin/echo a"), ("b.out", "/bin/echo b")])
+        job = self.runJob([("a.out", "/bin/echo a"), ("b.out", "/bin/echo b")])
+        self.assertEqual(job._description.procCount(), 0)
+        self.assertEqual(job.reused, [["a.out"], ["b.out"]])
+
+    def testFailedEntriesRunAgain(self):
+        self.runJob([("ok.out", "/bin/echo ok"), ("bad.out", "/bin/false")])
+        job = self.runJob([("ok.out", "/bin/echo ok"),
+                           ("bad.out", "/bin/false")])
+        self.assertEqual(job.reused, [["ok.out"]])
+        self.assertEqual(job._description.procCount(), 1)
+
+    def testChangedArgumentsRunAgain(self):
+        self.runJob([("a.out", "/bin/echo a")])
+        job = self.runJob([("a.out", "/bin/echo changed")])
+        self.assertEqual(job.reused, [])
+        with open("a.out") as f:
+            self.assertEqual(f.read(), "changed\n")
+
+    def testEntriesUsingProcessIdsAlwaysRun(self):
+        entries = [("out.$(Process)", "/bin/echo first"),
+                   ("out.$(Process)", "/bin/echo second")]
+        self.runJob(entries)
+        job = self.runJob(entries)
+        self.assertEqual(job.reused, [])
+        self.assertEqual(job._description.procCount(), 2)
+        for (name, text) in (("out.0", "first\n"), ("out.1", "second\n")):
+            with open(name) as f:
+                self.assertEqual(f.read(), text)
+
+class UserLogReturnValuesTest(unittest.TestCase):
+
+    def testTerminationEvents(self):
+        (handle, path) = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            with open(path, "w") as f:
+                f.write("000 (012.000.000) 10/16 12:00:00 Job submitted\n"
+                        "...\n"
+                        "005 (012.000.000) 10/16 12:00:05 Job terminated.\n"
+                        "\t(1) Normal termination (return value 0)\n"
+                        "...\n"
+                        "005 (012.001.000) 10/16 12:00:06 Job terminated.\n"
+                        "\t(1) Normal termination (return value 2)\n"
+                        "...\n"
+                        "005 (012.002.000) 10/16 12:00:07 Job terminated.\n"
+                        "\t(0) Abnormal termination (signal 9)\n"
+                        "...\n"
+                        "009 (012.003.000) 10/16 12:00:08 Job was aborted.\n"
+                        "...\n"
+                        "005 (012.004.000) 10/16 12:00:09 Job terminated.\n")
+            log = condor.UserLog(path)
+            log.read()
+            self.assertEqual(log.returnValues, {(12, 0): 0, (12, 1): 2,
+                                                (12, 2): None, (12, 3): None})
+        finally:
+            os.remove(path)
+
+if __name__ == "__main__":
+    unittest.main()